@@ -0,0 +1,132 @@
+"""Замер холодного старта бота.
+
+Запускает `python bot.py` отдельным процессом против заглушки Bot API и
+подложного `yc`, который отвечает через --yc-seconds. Меряет:
+
+  import          — время импорта модуля bot в чистом интерпретаторе;
+  first_poll      — от запуска процесса до первого getUpdates (бот принимает апдейты);
+  first_reply     — от запуска процесса до ответа на /start, отправленный заранее.
+
+    python -m bench.cold_start --runs 3 --yc-seconds 20
+"""
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+from bench.run import TOKEN, message_update
+from bench.telegram_stub import TelegramStub
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USER_ID = 42
+
+
+def fake_yc(directory, seconds):
+    """Скрипт yc, который выдаёт токен с задержкой, как настоящий CLI"""
+    path = os.path.join(directory, 'yc')
+    with open(path, 'w') as f:
+        f.write(f"#!/bin/sh\nsleep {seconds}\necho bench-token\n")
+    os.chmod(path, 0o755)
+
+
+async def measure_import():
+    code = "import time; t = time.perf_counter(); import bot; print(time.perf_counter() - t)"
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, '-c', code, cwd=ROOT, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+    )
+    out, _ = await proc.communicate()
+    return float(out.decode().strip())
+
+
+async def wait_for(predicate, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        result = predicate()
+        if result is not None:
+            return result
+        await asyncio.sleep(0.01)
+    return None
+
+
+async def measure_startup(args, bin_dir):
+    telegram = await TelegramStub().start()
+    telegram.updates.append(message_update(USER_ID, '/start'))
+    env = dict(
+        os.environ,
+        PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''),
+        TELEGRAM_BOT_TOKEN=TOKEN,
+        TELEGRAM_API_URL=telegram.base_url,
+        METRICS_PORT='0',
+        METERING_PATH=os.path.join(bin_dir, 'metering.sqlite3'),
+        MEDIA_SPOOL_DIR=os.path.join(bin_dir, 'spool'),
+    )
+    env.pop('YANDEX_IAM_TOKEN', None)
+    started = time.monotonic()
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, 'bot.py', cwd=ROOT, env=env,
+        stdout=asyncio.subprocess.DEVNULL, stderr=None if args.verbose else asyncio.subprocess.DEVNULL,
+    )
+    try:
+        first_poll = await wait_for(
+            lambda: next((t for t, m, _ in telegram.log if m == 'getUpdates'), None), args.timeout)
+        first_reply = await wait_for(
+            lambda: next((t for t, m, c in telegram.log if m == 'sendMessage' and c == USER_ID), None), args.timeout)
+    finally:
+        if proc.returncode is None:
+            proc.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(proc.wait(), 10)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+        await telegram.stop()
+    return {
+        'first_poll': first_poll - started if first_poll else None,
+        'first_reply': first_reply - started if first_reply else None,
+    }
+
+
+async def run(args):
+    samples = {'import': [], 'first_poll': [], 'first_reply': []}
+    with tempfile.TemporaryDirectory() as bin_dir:
+        fake_yc(bin_dir, args.yc_seconds)
+        for _ in range(args.runs):
+            samples['import'].append(await measure_import())
+            for key, value in (await measure_startup(args, bin_dir)).items():
+                if value is not None:
+                    samples[key].append(value)
+    return {
+        'runs': args.runs,
+        'yc_seconds': args.yc_seconds,
+        **{key: {'median': statistics.median(v), 'max': max(v)} if v else None for key, v in samples.items()},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Холодный старт бота')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--yc-seconds', type=float, default=10.0, help='сколько подложный yc отдаёт токен')
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--json', help='сохранить отчёт в JSON файл')
+    parser.add_argument('--verbose', action='store_true', help='показывать логи бота')
+    args = parser.parse_args(argv)
+    report = asyncio.run(run(args))
+    print(f"Запусков: {report['runs']}, yc отвечает за {report['yc_seconds']:.0f}с")
+    for key in ('import', 'first_poll', 'first_reply'):
+        s = report[key]
+        if s:
+            print(f"  {key:12} median {s['median']:7.3f}  max {s['max']:7.3f}")
+        else:
+            print(f"  {key:12} не дождались")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
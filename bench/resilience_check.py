@@ -0,0 +1,146 @@
+"""Проверка повторов, предохранителей и объединения запросов против заглушки с инъекцией ошибок.
+
+    python -m bench.resilience_check
+
+Каждый сценарий печатает OK/FAIL, код возврата ненулевой при любой ошибке.
+"""
+import os
+import sys
+import time
+import shutil
+import asyncio
+import tempfile
+import importlib
+
+from bench.stubs import StubServer
+from singleflight import SingleFlight
+
+
+async def run():
+    server = await StubServer().start()
+    workdir = tempfile.mkdtemp(prefix='resilience-check-')
+    os.environ.update(server.env())
+    os.environ.update({
+        'ART_POLL_INTERVAL': '0.05',
+        'RETRY_BASE_DELAY': '0.01',
+        'RETRY_MAX_DELAY': '0.05',
+        'BREAKER_FAILURE_THRESHOLD': '3',
+        'BREAKER_RESET_TIMEOUT': '0.5',
+        'PROMPT_HEDGE_DELAY': '5',
+        # Свой каталог спула: общий по умолчанию каталог может принадлежать работающему боту
+        'MEDIA_SPOOL_DIR': os.path.join(workdir, 'spool'),
+    })
+    resilience = importlib.import_module('resilience')
+    bot = importlib.import_module('bot')
+    bot.iam_token = 'stub-token'
+    failures = []
+
+    def check(name, condition):
+        print(f"{'OK  ' if condition else 'FAIL'} {name}")
+        if not condition:
+            failures.append(name)
+
+    try:
+        # 1. Временные 503 на отправке в Art повторяются и в итоге проходят
+        server.faults['art'].fail_next = 2
+        path = await bot.generate_image('тест')
+        check('art: повтор временных ошибок', path is not None and server.calls['art'] == 3)
+
+        # 2. Постоянные ошибки Art размыкают предохранитель, дальше отказ без запросов
+        server.faults['art'].error_rate = 1.0
+        for _ in range(3):
+            await bot.generate_image('тест')
+        check('art: предохранитель разомкнут', resilience.get_breaker('art').state == 'open')
+        calls_before = server.calls['art']
+        started = time.monotonic()
+        result = await bot.generate_image('тест')
+        check('art: быстрый отказ без запроса',
+              result is None and server.calls['art'] == calls_before and time.monotonic() - started < 0.1)
+
+        # 3. После reset_timeout пробный запрос замыкает предохранитель
+        server.faults['art'].error_rate = 0.0
+        await asyncio.sleep(0.6)
+        path = await bot.generate_image('тест')
+        check('art: half-open проба восстанавливает', path is not None and resilience.get_breaker('art').state == 'closed')
+
+        # 4. Ошибка основной модели промптов переключает на запасную
+        server.faults['llm'].error_rate = 1.0
+        state = {'hero': 'дракончик', 'place': 'лес', 'mood': 'волшебное', 'age': 'малыш'}
+        prompt = await bot.generate_ai_image_prompt(1, state, 'Дракончик летел. Он смотрел на звёзды.')
+        check('llm: fallback-промпт при недоступном LLM', prompt.startswith('детская книжная иллюстрация'))
+        server.faults['llm'].error_rate = 0.0
+
+        # 5. 400 от TTS не повторяется и не размыкает предохранитель
+        calls_before = server.calls['tts']
+        try:
+            await bot.synthesize_tts('а' * 6000, 'folder')
+            check('tts: ошибка длины текста', False)
+        except Exception as e:
+            check('tts: ошибка длины текста', str(e) == 'TTS_TEXT_TOO_LONG')
+        check('tts: 400 без повторов', server.calls['tts'] == calls_before + 1)
+        check('tts: предохранитель замкнут', resilience.get_breaker('tts').state == 'closed')
+
+        # 6. Одновременные одинаковые запросы к Art разделяют одну операцию
+        server.art_operation_seconds = 0.2
+        calls_before = server.calls['art']
+        images = await asyncio.gather(*(bot.generate_image('Одинаковый  промпт') for _ in range(5)),
+                                      bot.generate_image('одинаковый промпт'))
+        check('single-flight: одна операция Art на 6 запросов',
+              server.calls['art'] == calls_before + 1 and all(images))
+        # Картинка пишется в спул один раз, у каждого ожидающего своя ссылка на файл
+        path = images[0].path
+        check('спул: один файл на 6 ожидающих', len({image.path for image in images}) == 1 and os.path.exists(path))
+        for image in images[:-1]:
+            image.release()
+        exists_while_held = os.path.exists(path)
+        images[-1].release()
+        check('спул: файл удалён после последней ссылки', exists_while_held and not os.path.exists(path))
+
+        # 7. Отмена одного ожидающего не мешает остальным
+        calls_before = server.calls['art']
+        first = asyncio.ensure_future(bot.generate_image('отмена'))
+        second = asyncio.ensure_future(bot.generate_image('отмена'))
+        await asyncio.sleep(0.05)
+        first.cancel()
+        path = await second
+        check('single-flight: отмена одного ожидающего', path is not None and server.calls['art'] == calls_before + 1)
+
+        # 8. Ошибка общей операции доходит до всех ожидающих
+        server.faults['tts'].fail_next = 10
+        results = await asyncio.gather(*(bot.synthesize_tts('общий текст', 'folder') for _ in range(3)),
+                                       return_exceptions=True)
+        check('single-flight: ошибка у всех ожидающих', all(isinstance(r, Exception) for r in results))
+        server.faults['tts'].fail_next = 0
+        server.art_operation_seconds = 0.0
+
+        # 9. Новый вызов сразу после ухода последнего ожидающего начинает свой запрос, а не получает отмену
+        flights = SingleFlight('check')
+
+        async def slow(value):
+            await asyncio.sleep(0.1)
+            return value
+
+        first = asyncio.ensure_future(flights.do('ключ', slow, 1))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        # Один шаг цикла: ожидающий ушёл и отменил запрос, done-callback ещё не выполнен
+        await asyncio.sleep(0)
+        try:
+            result = await flights.do('ключ', slow, 2)
+        except asyncio.CancelledError:
+            result = None
+        check('single-flight: повторный вызов после отмены', result == 2 and flights.started == 2)
+    finally:
+        await bot.llm_router.close()
+        bot.media_spool.clear()
+        shutil.rmtree(workdir, ignore_errors=True)
+        await server.stop()
+    return not failures
+
+
+def main():
+    sys.exit(0 if asyncio.run(run()) else 1)
+
+
+if __name__ == '__main__':
+    main()
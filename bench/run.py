@@ -0,0 +1,374 @@
+"""Нагрузочный тест бота на локальных заглушках.
+
+Апдейты проходят через настоящее приложение PTB (build_application) с настоящим
+telegram.Bot, который ходит в заглушку Bot API; NeuroAPI, Yandex Art и TTS тоже
+заглушены. Латентность кнопки — от постановки апдейта в очередь до ответа бота,
+то есть с учётом ожидания за апдейтами других пользователей. Каждый пользователь проходит /start -> герой -> место -> настроение ->
+возраст -> длина (сказка) -> /audio. С --replay затем все пользователи повторяют
+свою сказку из /library: отчёт показывает время повтора и вызовы бэкендов за эту фазу.
+
+    python -m bench.run --users 20 --art-seconds 2 --llm-latency 1
+    python -m bench.run --users 20 --delivery album --json result.json
+    python -m bench.run --users 20 --baseline result.json   # код 1 при регрессии p95
+    python -m bench.run --users 20 --replay
+    python -m bench.run --users 50 --art-image large --dispatch direct   # хэндлеры напрямую, без PTB
+    python -m bench.run --art-image large --tg-bandwidth 2000000 --no-transcode   # PNG как есть
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import importlib
+import itertools
+import tempfile
+import statistics
+from types import SimpleNamespace
+
+from bench.stubs import StubServer
+from bench.telegram_stub import TelegramStub
+
+TOKEN = '123456:BENCH'
+# Вызовы Bot API, которыми бот отвечает пользователю
+REPLY_METHODS = ('sendMessage', 'editMessageText', 'sendPhoto', 'sendMediaGroup', 'sendVoice')
+_update_ids = itertools.count(1)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p * (len(values) - 1))))]
+
+
+def summarize(values):
+    if not values:
+        return {}
+    return {
+        'count': len(values),
+        'mean': statistics.mean(values),
+        'p50': percentile(values, 0.5),
+        'p95': percentile(values, 0.95),
+        'p99': percentile(values, 0.99),
+        'max': max(values),
+    }
+
+
+def user_json(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'}
+
+
+def message_update(user_id, text):
+    message = {
+        'message_id': next(_update_ids),
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': user_json(user_id),
+        'text': text,
+    }
+    if text.startswith('/'):
+        command = text.split()[0]
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+    return {'update_id': next(_update_ids), 'message': message}
+
+
+def callback_update(user_id, data):
+    return {
+        'update_id': next(_update_ids),
+        'callback_query': {
+            'id': str(next(_update_ids)),
+            'from': user_json(user_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': next(_update_ids),
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'text': 'keyboard',
+            },
+        },
+    }
+
+
+class Harness:
+    def __init__(self, args):
+        self.args = args
+        self.results = {'keyboard': [], 'ttfm': [], 'first_part': [], 'silence': [], 'story': [], 'audio': [],
+                        'api_calls': [], 'replay': [], 'errors': 0}
+        self.replay_backend_calls = {}
+
+    async def setup(self):
+        args = self.args
+        self.backends = await StubServer(art_operation_seconds=args.art_seconds, art_image=args.art_image,
+                                         unique_prompts=args.unique_prompts).start()
+        self.backends.faults['llm'].latency = args.llm_latency
+        self.backends.faults['llm'].jitter = args.jitter
+        self.backends.faults['art'].error_rate = args.error_rate
+        self.backends.faults['llm'].error_rate = args.error_rate
+        self.backends.faults['tts'].latency = args.tts_latency
+        self.backends.faults['tts'].error_rate = args.error_rate
+        self.telegram = await TelegramStub(latency=args.tg_latency, bandwidth=args.tg_bandwidth).start()
+
+        os.environ.update(self.backends.env())
+        os.environ.update({
+            'ART_POLL_INTERVAL': str(args.poll_interval),
+            'STORY_DELIVERY_MODE': args.delivery,
+            'LOG_PAYLOAD_SAMPLE_RATE': '0',
+            'IMAGE_TRANSCODE': '0' if args.no_transcode else '1',
+        })
+        self.library_dir = tempfile.mkdtemp(prefix='bench-library-')
+        os.environ['LIBRARY_PATH'] = os.path.join(self.library_dir, 'library.sqlite3')
+        # Свой каталог спула: общий по умолчанию каталог может принадлежать работающему боту
+        os.environ['MEDIA_SPOOL_DIR'] = os.path.join(self.library_dir, 'spool')
+        self.bot_module = importlib.import_module('bot')
+        self.bot_module.iam_token = 'bench-token'
+
+        if args.dispatch == 'application':
+            self.app = self.bot_module.build_application(TOKEN, base_url=self.telegram.base_url)
+            await self.app.initialize()
+            await self.app.start()
+            self.bot = self.app.bot
+        else:
+            from telegram import Bot
+            self.app = None
+            self.bot = Bot(TOKEN, base_url=self.telegram.base_url)
+            await self.bot.initialize()
+
+    async def teardown(self):
+        if self.app is not None:
+            await self.app.stop()
+            await self.app.shutdown()
+        else:
+            await self.bot.shutdown()
+        await self.bot_module.llm_router.close()
+        await self.telegram.stop()
+        await self.backends.stop()
+        self.bot_module.story_library.close()
+        # Файлы, оставшиеся в спуле после всех сказок и озвучки, — утечки
+        self.spool = self.bot_module.media_spool.snapshot()
+        self.bot_module.media_spool.clear()
+        shutil.rmtree(self.library_dir, ignore_errors=True)
+
+    async def dispatch(self, handler, payload, user_id):
+        """Обработать апдейт и дождаться первого ответа бота в чат (без фоновых задач)"""
+        from telegram import Update
+        update = Update.de_json(payload, self.bot)
+        started = time.monotonic()
+        if self.app is not None:
+            await self.app.update_queue.put(update)
+        else:
+            await handler(update, SimpleNamespace(bot=self.bot))
+        await self.telegram.wait_call(user_id, started, REPLY_METHODS)
+
+    async def finish_jobs(self, user_id):
+        """Дождаться фоновых задач пользователя: сказки или озвучки"""
+        await self.bot_module.scheduler.join(user_id)
+
+    async def click(self, user_id, data):
+        started = time.monotonic()
+        await self.dispatch(self.bot_module.button, callback_update(user_id, data), user_id)
+        self.results['keyboard'].append(time.monotonic() - started)
+
+    async def run_user(self, user_id):
+        b = self.bot_module
+        try:
+            await self.dispatch(b.start, message_update(user_id, '/start'), user_id)
+            if random.random() < self.args.custom_rate:
+                # Свой вариант героя: кнопка "custom", затем текстовое сообщение
+                await self.click(user_id, 'custom')
+                started = time.monotonic()
+                await self.dispatch(b.text_handler, message_update(user_id, f'котёнок {user_id}'), user_id)
+                self.results['keyboard'].append(time.monotonic() - started)
+            else:
+                await self.click(user_id, random.choice(b.HEROES[:-1])[1])
+            for data in (random.choice(b.PLACES[:-1])[1], random.choice(b.MOODS)[1], random.choice(b.AGES)[1]):
+                await self.click(user_id, data)
+
+            started = time.monotonic()
+            await self.dispatch(b.button, callback_update(user_id, self.args.length), user_id)
+            await self.finish_jobs(user_id)
+            self.results['story'].append(time.monotonic() - started)
+            # Время до первого сообщения сказки: первая картинка или текст после "Готовлю..."
+            calls = self.telegram.calls_for(user_id, since=started)
+            first = next((t for t, m in calls if m in ('sendMessage', 'sendPhoto', 'sendMediaGroup')), None)
+            if first is not None:
+                self.results['ttfm'].append(first - started)
+            # От "Готово!" (текст сказки получен) до первой части в чате
+            ready = [t for t, m in calls if m == 'editMessageText'][-1:]
+            first_part = next((t for t, m in calls if ready and t > ready[0]
+                               and m in ('sendMessage', 'sendPhoto', 'sendMediaGroup')), None)
+            if first_part is not None:
+                self.results['first_part'].append(first_part - ready[0])
+            # Самая долгая пауза без сообщений и статусов: статус "загружает фото" виден ~5 секунд
+            times = [t for t, _ in calls]
+            self.results['silence'].append(max((b - a for a, b in zip(times, times[1:])), default=0.0))
+            self.results['api_calls'].append(len(calls))
+
+            if not self.args.no_audio:
+                started = time.monotonic()
+                await self.dispatch(b.audio_cmd, message_update(user_id, '/audio'), user_id)
+                await self.finish_jobs(user_id)
+                self.results['audio'].append(time.monotonic() - started)
+        except Exception as e:
+            self.results['errors'] += 1
+            print(f"user {user_id}: {type(e).__name__}: {e}", file=sys.stderr)
+
+    async def replay_user(self, user_id):
+        """/library -> повтор последней сказки -> /audio (по сохранённым file_id)"""
+        b = self.bot_module
+        try:
+            await self.dispatch(b.library_cmd, message_update(user_id, '/library'), user_id)
+            stories = await b.story_library.recent(user_id, limit=1)
+            if not stories:
+                raise RuntimeError('сказка не попала в библиотеку')
+            started = time.monotonic()
+            await self.dispatch(b.button, callback_update(user_id, f"lib:{stories[0]['id']}"), user_id)
+            await self.finish_jobs(user_id)
+            if not self.args.no_audio:
+                await self.dispatch(b.audio_cmd, message_update(user_id, '/audio'), user_id)
+                await self.finish_jobs(user_id)
+            self.results['replay'].append(time.monotonic() - started)
+        except Exception as e:
+            self.results['errors'] += 1
+            print(f"user {user_id} replay: {type(e).__name__}: {e}", file=sys.stderr)
+
+    async def run(self):
+        await self.setup()
+        try:
+            started = time.monotonic()
+            users = [10_000 + i for i in range(self.args.users)]
+            tasks = []
+            for user_id in users:
+                tasks.append(asyncio.ensure_future(self.run_user(user_id)))
+                if self.args.ramp:
+                    await asyncio.sleep(self.args.ramp / max(1, self.args.users))
+            await asyncio.gather(*tasks)
+            elapsed = time.monotonic() - started
+            if self.args.replay:
+                before = dict(self.backends.calls)
+                await asyncio.gather(*(self.replay_user(user_id) for user_id in users))
+                self.replay_backend_calls = {k: v - before.get(k, 0) for k, v in self.backends.calls.items()}
+        finally:
+            await self.teardown()
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        r = self.results
+        upload_photo = self.bot_module.metrics.HISTOGRAMS.get('upload_photo')
+        return {
+            'users': self.args.users,
+            'delivery': self.args.delivery,
+            'dispatch': self.args.dispatch,
+            'elapsed': elapsed,
+            'stories_per_minute': len(r['story']) / elapsed * 60 if elapsed else 0,
+            'errors': r['errors'],
+            'keyboard': summarize(r['keyboard']),
+            'time_to_first_message': summarize(r['ttfm']),
+            'time_to_first_part': summarize(r['first_part']),
+            'max_silence': summarize(r['silence']),
+            'story_end_to_end': summarize(r['story']),
+            'audio': summarize(r['audio']),
+            'bot_api_calls_per_story': summarize(r['api_calls']),
+            'upload_photo': summarize(list(upload_photo.recent) if upload_photo else []),
+            'library_replay': summarize(r['replay']),
+            'replay_backend_calls': self.replay_backend_calls,
+            'images': self.bot_module.imaging.snapshot(),
+            'spool': self.spool,
+            'backend_calls': dict(self.backends.calls),
+            'cost': self.bot_module.metering.snapshot(),
+        }
+
+
+def print_report(report):
+    print(f"Пользователей: {report['users']}, доставка: {report['delivery']}, апдейты: {report['dispatch']}, "
+          f"время: {report['elapsed']:.1f}с, сказок/мин: {report['stories_per_minute']:.1f}, "
+          f"ошибок: {report['errors']}")
+    for key in ('keyboard', 'time_to_first_message', 'time_to_first_part', 'max_silence', 'story_end_to_end',
+                'audio', 'bot_api_calls_per_story', 'upload_photo', 'library_replay'):
+        s = report[key]
+        if s:
+            print(f"  {key:24} p50 {s['p50']:8.3f}  p95 {s['p95']:8.3f}  p99 {s['p99']:8.3f}  max {s['max']:8.3f}")
+    print(f"  вызовы бэкендов: {report['backend_calls']}")
+    if report['library_replay']:
+        print(f"  вызовы бэкендов при повторе из библиотеки: {report['replay_backend_calls']}")
+    images = report['images']
+    if images['images']:
+        print(f"  картинки: {images['format']} q{images['quality']}, {images['images']} шт., "
+              f"в среднем -{images['avg_saved'] / 1e3:.0f} КБ, {images['ratio'] * 100:.0f}% от исходного размера")
+    spool = report['spool']
+    print(f"  спул медиа: записано {spool['written']}, общих ссылок {spool['shared']}, "
+          f"осталось после прогона {spool['files']} ({spool['bytes'] / 1e3:.0f} КБ)")
+    cost = report['cost']
+    print(f"  стоимость: всего {cost['cost_today']:.2f}, на сказку {cost['avg_story_cost']:.2f}, "
+          f"токенов {cost['tokens_in_today']}/{cost['tokens_out_today']}, картинок {cost['images_today']}")
+
+
+def find_regressions(report, baseline, tolerance):
+    """Метрики, у которых p95 вырос больше чем на tolerance относительно baseline"""
+    regressions = []
+    for key in ('keyboard', 'time_to_first_message', 'time_to_first_part', 'max_silence', 'story_end_to_end',
+                'audio', 'bot_api_calls_per_story', 'upload_photo'):
+        old, new = baseline.get(key, {}).get('p95'), report.get(key, {}).get('p95')
+        if old and new and new > old * (1 + tolerance):
+            regressions.append(f"{key}: p95 {old:.3f} -> {new:.3f}")
+    if report['errors'] > baseline.get('errors', 0):
+        regressions.append(f"errors: {baseline.get('errors', 0)} -> {report['errors']}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Нагрузочный тест бота на заглушках')
+    parser.add_argument('--users', type=int, default=10, help='одновременных пользователей')
+    parser.add_argument('--ramp', type=float, default=0.0, help='растянуть старт пользователей на N секунд')
+    parser.add_argument('--length', default='short', choices=['short', 'medium', 'long'])
+    parser.add_argument('--delivery', default='parts', choices=['parts', 'album'])
+    parser.add_argument('--llm-latency', type=float, default=0.2)
+    parser.add_argument('--tts-latency', type=float, default=0.2)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--art-seconds', type=float, default=1.0, help='время асинхронной операции Art')
+    parser.add_argument('--poll-interval', type=float, default=0.2, help='ART_POLL_INTERVAL бота')
+    parser.add_argument('--tg-latency', type=float, default=0.02, help='задержка Bot API')
+    parser.add_argument('--tg-bandwidth', type=float, default=0, help='канал до Bot API, байт/с (0 — без ограничения)')
+    parser.add_argument('--unique-prompts', action='store_true',
+                        help='разные промпты иллюстраций: каждая картинка — своя операция Art')
+    parser.add_argument('--art-image', default='tiny', choices=['tiny', 'large'], help='картинка от заглушки Art')
+    parser.add_argument('--no-transcode', action='store_true', help='отправлять картинки без перекодирования')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--custom-rate', type=float, default=0.2, help='доля пользователей со своим героем')
+    parser.add_argument('--no-audio', action='store_true')
+    parser.add_argument('--replay', action='store_true', help='затем повторить сказки из /library')
+    parser.add_argument('--dispatch', default='application', choices=['application', 'direct'],
+                        help='через приложение PTB или прямым вызовом хэндлеров')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='сохранить отчёт в JSON файл')
+    parser.add_argument('--verbose', action='store_true', help='не глушить логи бота')
+    parser.add_argument('--baseline', help='JSON отчёт для сравнения: ненулевой код при регрессии p95')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='допустимое ухудшение p95 относительно baseline')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    random.seed(args.seed)
+    if not args.verbose:
+        import logging
+        logging.disable(logging.ERROR)
+    report = asyncio.run(Harness(args).run())
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = find_regressions(report, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"РЕГРЕССИЯ {line}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+"""Проверка остановки бота посреди генерации сказок.
+
+Запускает `python bot.py` против заглушек Bot API и бэкендов, начинает сказки
+нескольких пользователей и посылает SIGTERM, как docker-compose при редеплое:
+
+  дожидается  — задачи успевают за DRAIN_TIMEOUT: все сказки дописаны и сохранены;
+  по дедлайну — Art отвечает дольше DRAIN_TIMEOUT: сказки прерываются, текст
+                сохраняется в библиотеку, пользователь получает сообщение.
+
+В обоих сценариях бот должен выйти сам, без брошенных задач, предупреждений
+asyncio и временных файлов.
+
+    python -m bench.shutdown_check
+"""
+import os
+import sys
+import time
+import signal
+import sqlite3
+import asyncio
+import logging
+import importlib
+import tempfile
+
+from bench.run import TOKEN, message_update, callback_update
+from bench.stubs import StubServer
+from bench.telegram_stub import TelegramStub
+from library import StoryLibrary
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Признаки неаккуратной остановки в логах бота
+LEAK_MARKERS = ('Task was destroyed but it is pending', 'Event loop is closed', 'Traceback', 'не завершились после отмены')
+
+
+async def wait_for(predicate, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+
+def story_updates(bot, user_id):
+    """/start и все кнопки до выбора длины"""
+    choices = (bot.HEROES[0][1], bot.PLACES[0][1], bot.MOODS[0][1], bot.AGES[0][1], 'short')
+    return [message_update(user_id, '/start')] + [callback_update(user_id, data) for data in choices]
+
+
+async def run_scenario(bot, users, art_seconds, drain_timeout, stop_when, timeout=60):
+    """Запустить бота, начать сказки users, остановить по stop_when(telegram); вернуть итог"""
+    backends = await StubServer(art_operation_seconds=art_seconds).start()
+    telegram = await TelegramStub().start()
+    with tempfile.TemporaryDirectory() as workdir:
+        spool = os.path.join(workdir, 'tmp')
+        os.mkdir(spool)
+        library_path = os.path.join(workdir, 'library.sqlite3')
+        metering_path = os.path.join(workdir, 'metering.sqlite3')
+        env = dict(
+            os.environ,
+            **backends.env(),
+            TELEGRAM_BOT_TOKEN=TOKEN,
+            TELEGRAM_API_URL=telegram.base_url,
+            YANDEX_IAM_TOKEN='check-token',
+            LIBRARY_PATH=library_path,
+            METERING_PATH=metering_path,
+            ART_POLL_INTERVAL='0.1',
+            DRAIN_TIMEOUT=str(drain_timeout),
+            DRAIN_GRACE='5',
+            # Все временные файлы бота попадают сюда: после остановки каталог должен быть пуст
+            TMPDIR=spool,
+            METRICS_PORT='0',
+        )
+        for user_id in users:
+            telegram.updates.extend(story_updates(bot, user_id))
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, 'bot.py', cwd=ROOT, env=env,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+        )
+        stderr = proc.stderr.read()
+        try:
+            started = await wait_for(lambda: stop_when(telegram), timeout)
+            proc.send_signal(signal.SIGTERM)
+            stop_started = time.monotonic()
+            try:
+                await asyncio.wait_for(proc.wait(), drain_timeout + 15)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+            stop_seconds = time.monotonic() - stop_started
+            log = (await stderr).decode('utf-8', 'replace')
+        finally:
+            await telegram.stop()
+            await backends.stop()
+        library = StoryLibrary(library_path)
+        stories = {user_id: [await library.get(user_id, s['id']) for s in await library.recent(user_id)]
+                   for user_id in users}
+        library.close()
+        with sqlite3.connect(metering_path) as db:
+            usage = {user_id: (stories, cost) for user_id, stories, cost
+                     in db.execute('SELECT user_id, stories, cost FROM usage')}
+        return {
+            'started': started,
+            'returncode': proc.returncode,
+            'stop_seconds': stop_seconds,
+            'log': log,
+            'leftover_files': os.listdir(spool),
+            'stories': stories,
+            'texts': list(telegram.texts),
+            'usage': usage,
+        }
+
+
+def has_text(texts, user_id, fragment):
+    return any(chat == user_id and fragment in text for chat, text in texts)
+
+
+async def run():
+    os.environ.setdefault('LIBRARY_PATH', os.path.join(tempfile.gettempdir(), 'shutdown-check-unused.sqlite3'))
+    bot = importlib.import_module('bot')
+    # Журнал запросов к заглушкам здесь не нужен, логи бота проверяются отдельно
+    logging.getLogger('aiohttp.access').setLevel(logging.WARNING)
+    failures = []
+
+    def check(name, condition):
+        print(f"{'OK  ' if condition else 'FAIL'} {name}")
+        if not condition:
+            failures.append(name)
+
+    def check_clean(scenario, result, deadline):
+        check(f'{scenario}: бот вышел сам за {deadline:.0f}с',
+              result['returncode'] == 0 and result['stop_seconds'] < deadline)
+        leaks = [marker for marker in LEAK_MARKERS if marker in result['log']]
+        check(f'{scenario}: без брошенных задач и ошибок в логе', not leaks)
+        if leaks:
+            print(f"     в логе: {leaks}")
+        check(f'{scenario}: временные файлы удалены', not result['leftover_files'])
+        if result['leftover_files']:
+            print(f"     осталось: {result['leftover_files']}")
+
+    users = [501, 502, 503]
+
+    # 1. Сказки успевают за DRAIN_TIMEOUT: SIGTERM сразу после старта генерации, все дописаны
+    result = await run_scenario(
+        bot, users, art_seconds=0.5, drain_timeout=30,
+        stop_when=lambda tg: all(has_text(tg.texts, u, 'Готовлю сказку') for u in users),
+    )
+    check('дожидается: сказки начаты до SIGTERM', result['started'])
+    check('дожидается: все сказки дописаны и сохранены',
+          all(len(result['stories'][u]) == 1 and has_text(result['texts'], u, 'Готово!') for u in users))
+    check('дожидается: никто не прерван', not any(has_text(result['texts'], u, 'перезапускается') for u in users))
+    check('дожидается: расходы сохранены на диск',
+          all(result['usage'].get(u, (0, 0))[0] == 1 and result['usage'][u][1] > 0 for u in users))
+    check_clean('дожидается', result, 30)
+
+    # 2. Art дольше DRAIN_TIMEOUT: прерываем после текста сказки, сохраняем недосказанное
+    result = await run_scenario(
+        bot, users, art_seconds=3, drain_timeout=0.5,
+        stop_when=lambda tg: all(has_text(tg.texts, u, 'Готово!') for u in users),
+    )
+    check('по дедлайну: текст сказок получен до SIGTERM', result['started'])
+    saved = [result['stories'][u] for u in users]
+    check('по дедлайну: прерванные сказки в библиотеке целиком',
+          all(len(entries) == 1 and all(part in {s[1] for s in entries[0]['steps'] if s[0] == 'text'}
+                                        for part in bot.split_story_into_sentences(entries[0]['text']))
+              for entries in saved))
+    check('по дедлайну: пользователи предупреждены', all(has_text(result['texts'], u, '/library') for u in users))
+    check_clean('по дедлайну', result, 0.5 + 5 + 5)
+    return not failures
+
+
+def main():
+    sys.exit(0 if asyncio.run(run()) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""Проверка спула медиафайлов: ссылки, квота, утечки и посторонние файлы.
+
+    python -m bench.spool_check
+
+Каждый сценарий печатает OK/FAIL, код возврата ненулевой при любой ошибке.
+"""
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import subprocess
+
+import metrics
+from spool import MediaSpool
+
+
+def write(path, size):
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+
+
+async def run():
+    failures = []
+
+    def check(name, condition):
+        print(f"{'OK  ' if condition else 'FAIL'} {name}")
+        if not condition:
+            failures.append(name)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        directory = os.path.join(workdir, 'spool')
+        os.makedirs(directory)
+        # Файлы процесса, убитого без остановки, и файл прошлого процесса с нашим pid (перезапуск контейнера)
+        dead = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'],
+                              capture_output=True, text=True).stdout.strip()
+        for name in (f'{dead}-1.jpg', f'{dead}-2.ogg', f'{os.getpid()}-999.jpg'):
+            write(os.path.join(directory, name), 1000)
+        # Файл другого живого процесса (второй экземпляр бота или бенчмарк в том же каталоге)
+        foreign = os.path.join(directory, f'{os.getppid()}-1.jpg')
+        write(foreign, 1000)
+        spool = MediaSpool(directory, max_bytes=10_000, max_age=60)
+
+        def own_files():
+            return [name for name in os.listdir(directory) if name != os.path.basename(foreign)]
+
+        # 1. При запуске удаляются файлы завершившихся процессов, файлы живых остаются
+        await spool.start()
+        check('запуск: файлы прошлых процессов удалены', os.listdir(directory) == [os.path.basename(foreign)]
+              and spool.stats['orphans'] == 3)
+
+        # 2. Одновременная запись по одному ключу — один файл и несколько ссылок
+        handles = await asyncio.gather(*(spool.write(b'a' * 1000, '.jpg', key='k') for _ in range(3)))
+        check('ссылки: один файл на ключ', len({h.path for h in handles}) == 1 and len(own_files()) == 1)
+        handles[0].release()
+        handles[0].release()
+        check('ссылки: повторное освобождение не считается', os.path.exists(handles[1].path))
+        handles[1].release()
+        handles[2].release()
+        check('ссылки: файл удалён после последней ссылки', not own_files() and spool.bytes == 0)
+
+        # 3. Превышение квоты не трогает файлы в работе, а утечки старше max_age вытесняет
+        old = await spool.write(b'b' * 6000, '.jpg')
+        new = await spool.write(b'c' * 6000, '.jpg')
+        check('квота: файлы в работе не вытесняются', os.path.exists(old.path) and os.path.exists(new.path)
+              and spool.bytes == 12000 and spool.stats['evicted'] == 0)
+        spool.max_age = 0
+        await asyncio.sleep(0.01)
+        extra = await spool.write(b'g' * 1000, '.jpg')
+        check('квота: вытеснена старейшая утечка', not os.path.exists(old.path) and os.path.exists(new.path)
+              and spool.bytes == 7000 and spool.stats['evicted'] == 1)
+        spool.max_age = 60
+        for handle in (old, new, extra):
+            handle.release()
+
+        # 4. Неосвобождённая ссылка старше max_age — утечка, удаляется при проверке
+        leaked = await spool.write(b'd' * 100, '.ogg')
+        spool.max_age = 0
+        await asyncio.sleep(0.01)
+        await spool.sweep()
+        check('утечка: файл старше max_age удалён', not os.path.exists(leaked.path) and spool.stats['leaked'] == 1)
+        spool.max_age = 60
+
+        # 5. Файл, записанный внешним процессом по reserve, учитывается в размере
+        reserved = spool.reserve('.mp3')
+        with open(reserved.path, 'wb') as f:
+            f.write(b'e' * 500)
+        spool.commit(reserved)
+        # Файл без pid в имени удаляется, только когда он старше max_age
+        fresh, stale = os.path.join(directory, 'fresh.tmp'), os.path.join(directory, 'stale.tmp')
+        write(fresh, 1)
+        write(stale, 1)
+        os.utime(stale, (time.time() - 120, time.time() - 120))
+        await spool.sweep()
+        check('reserve: размер учтён, файл не принят за посторонний',
+              os.path.exists(reserved.path) and spool.bytes == 500)
+        check('посторонние: старый файл без pid удалён, свежий и файл живого процесса оставлены',
+              not os.path.exists(stale) and os.path.exists(fresh) and os.path.exists(foreign))
+        os.unlink(fresh)
+        check('метрики: размер спула в gauge', metrics.GAUGES.get('spool_bytes') == 500
+              and metrics.GAUGES.get('spool_files') == 1)
+
+        # 6. Остановка удаляет свои файлы, включая неосвобождённые; каталог — когда в нём не осталось чужих
+        spool.clear()
+        check('остановка: свои файлы удалены, файл живого процесса оставлен',
+              not own_files() and os.path.exists(foreign))
+        os.unlink(foreign)
+        spool.clear()
+        check('остановка: пустой каталог спула удалён', not os.path.exists(directory))
+    return not failures
+
+
+def main():
+    sys.exit(0 if asyncio.run(run()) else 1)
+
+
+if __name__ == '__main__':
+    main()
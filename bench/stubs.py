@@ -0,0 +1,225 @@
+"""Локальные заглушки внешних API (NeuroAPI, Yandex Art, SpeechKit) с инъекцией ошибок.
+
+Запуск отдельным процессом:
+    python -m bench.stubs --port 8099 --error-rate 0.2
+
+и затем бот с NEUROAPI_URL / YANDEX_ART_URL / YANDEX_OPERATIONS_URL / YANDEX_TTS_URL,
+указывающими на заглушку (см. StubServer.env()).
+"""
+import time
+import zlib
+import uuid
+import struct
+import base64
+import random
+import asyncio
+import argparse
+import logging
+
+from aiohttp import web
+
+# Минимальный валидный PNG 1x1, чтобы бот мог сохранить и отправить картинку
+TINY_PNG = base64.b64decode(
+    'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg=='
+)
+
+
+def art_png(width=1536, height=768, seed=0):
+    """PNG размером с настоящий результат Art 2:1: градиент с шумом, плохо сжимается, как иллюстрация"""
+    rng = random.Random(seed)
+    raw = bytearray()
+    for y in range(height):
+        gradient = [v for x in range(width) for v in (x * 255 // width, y * 255 // height, 160)]
+        raw.append(0)
+        raw += bytes((g + (n & 15)) & 255 for g, n in zip(gradient, rng.randbytes(width * 3)))
+
+    def chunk(kind, body):
+        return struct.pack('>I', len(body)) + kind + body + struct.pack('>I', zlib.crc32(kind + body))
+
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(bytes(raw), 6)) + chunk(b'IEND', b''))
+
+
+STORY_TEXT = ' '.join(
+    f"Жил-был маленький дракончик номер {i}, и каждый вечер он смотрел на звёзды." for i in range(40)
+)
+
+
+class Faults:
+    """Настройки задержек и ошибок для одного бэкенда"""
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, error_status=503, fail_next=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        # Сколько ближайших запросов гарантированно завершить ошибкой
+        self.fail_next = fail_next
+
+    async def apply(self):
+        """Подождать и, возможно, вернуть ответ-ошибку"""
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        if self.fail_next > 0:
+            self.fail_next -= 1
+            return web.Response(status=self.error_status, text=f"injected error {self.error_status}")
+        if self.error_rate and random.random() < self.error_rate:
+            return web.Response(status=self.error_status, text=f"injected error {self.error_status}")
+        return None
+
+
+class StubServer:
+    """aiohttp сервер, эмулирующий NeuroAPI, Yandex Art (асинхронные операции) и TTS"""
+    def __init__(self, host='127.0.0.1', port=0, art_operation_seconds=0.0, art_image='tiny', unique_prompts=False):
+        self.host = host
+        self.port = port
+        self.art_operation_seconds = art_operation_seconds
+        # Разные промпты иллюстраций на каждый запрос: картинки не склеиваются single-flight
+        self.unique_prompts = unique_prompts
+        # 'tiny' — PNG 1x1, 'large' — PNG 1536x768 как у настоящего Art
+        self.art_image = art_image
+        self._image_b64 = None
+        self.faults = {
+            'llm': Faults(),
+            'art': Faults(),
+            'operations': Faults(),
+            'tts': Faults(),
+        }
+        # Задержка по имени модели (для проверки хеджирования)
+        self.model_latency = {}
+        self.calls = {name: 0 for name in self.faults}
+        self.operations = {}
+        self._runner = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def env(self):
+        """Переменные окружения, направляющие бота на заглушку"""
+        return {
+            'NEUROAPI_URL': f"{self.base_url}/v1/chat/completions",
+            'YANDEX_ART_URL': f"{self.base_url}/foundationModels/v1/imageGenerationAsync",
+            'YANDEX_OPERATIONS_URL': f"{self.base_url}/operations",
+            'YANDEX_TTS_URL': f"{self.base_url}/speech/v1/tts:synthesize",
+        }
+
+    def build_app(self):
+        app = web.Application()
+        app.router.add_post('/v1/chat/completions', self.chat)
+        app.router.add_post('/foundationModels/v1/imageGenerationAsync', self.art_submit)
+        app.router.add_get('/operations/{op_id}', self.art_operation)
+        app.router.add_post('/speech/v1/tts:synthesize', self.tts)
+        app.router.add_post('/_faults', self.set_faults)
+        return app
+
+    async def start(self):
+        # Картинку готовим заранее и в потоке: генерация в обработчике остановила бы цикл событий бота
+        await asyncio.to_thread(self.image_b64)
+        self._runner = web.AppRunner(self.build_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def chat(self, request):
+        self.calls['llm'] += 1
+        data = await request.json()
+        model = data.get('model', '')
+        if model in self.model_latency:
+            await asyncio.sleep(self.model_latency[model])
+        failed = await self.faults['llm'].apply()
+        if failed is not None:
+            return failed
+        is_prompt = any(m.get('role') == 'system' for m in data.get('messages', []))
+        content = "детская книжная иллюстрация: дракончик смотрит на звёзды" if is_prompt else STORY_TEXT
+        if is_prompt and self.unique_prompts:
+            content += f", сцена {self.calls['llm']}"
+        prompt_tokens = sum(len(m.get('content', '')) // 4 for m in data.get('messages', []))
+        return web.json_response({
+            'model': model,
+            'choices': [{'message': {'role': 'assistant', 'content': content}}],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': len(content) // 4,
+                'total_tokens': prompt_tokens + len(content) // 4,
+            },
+        })
+
+    async def art_submit(self, request):
+        self.calls['art'] += 1
+        failed = await self.faults['art'].apply()
+        if failed is not None:
+            return failed
+        op_id = uuid.uuid4().hex
+        self.operations[op_id] = time.monotonic() + self.art_operation_seconds
+        return web.json_response({'id': op_id, 'done': False})
+
+    async def art_operation(self, request):
+        self.calls['operations'] += 1
+        failed = await self.faults['operations'].apply()
+        if failed is not None:
+            return failed
+        op_id = request.match_info['op_id']
+        ready_at = self.operations.get(op_id)
+        if ready_at is None:
+            return web.Response(status=404, text='operation not found')
+        if time.monotonic() < ready_at:
+            return web.json_response({'id': op_id, 'done': False})
+        # Тело собирается без json.dumps: сериализация мегабайт base64 в общем цикле событий искажала бы замеры бота
+        body = '{"id": "%s", "done": true, "response": {"image": "%s"}}' % (op_id, self.image_b64())
+        return web.Response(text=body, content_type='application/json')
+
+    def image_b64(self):
+        if self._image_b64 is None:
+            image = art_png() if self.art_image == 'large' else TINY_PNG
+            self._image_b64 = base64.b64encode(image).decode()
+        return self._image_b64
+
+    async def tts(self, request):
+        self.calls['tts'] += 1
+        data = await request.post()
+        failed = await self.faults['tts'].apply()
+        if failed is not None:
+            return failed
+        if len(data.get('text', '')) > 5000:
+            return web.Response(status=400, text='Requested text length exceed limitation')
+        return web.Response(body=b'OggS' + b'\x00' * 256, content_type='audio/ogg')
+
+    async def set_faults(self, request):
+        """POST /_faults {"art": {"error_rate": 1.0}} — поменять настройки на лету"""
+        data = await request.json()
+        for name, params in data.items():
+            faults = self.faults[name]
+            for key, value in params.items():
+                setattr(faults, key, value)
+        return web.json_response({name: vars(f) for name, f in self.faults.items()})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Заглушки внешних API бота')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--art-seconds', type=float, default=0.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = StubServer(args.host, args.port, art_operation_seconds=args.art_seconds)
+    for faults in server.faults.values():
+        faults.latency = args.latency
+        faults.error_rate = args.error_rate
+    for key, value in server.env().items():
+        print(f"{key}={value}")
+    web.run_app(server.build_app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
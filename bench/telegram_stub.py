@@ -0,0 +1,125 @@
+"""Заглушка Telegram Bot API: принимает вызовы настоящего telegram.Bot и записывает их."""
+import time
+import random
+import asyncio
+import itertools
+
+from aiohttp import web
+
+BOT_USER = {'id': 1000, 'is_bot': True, 'first_name': 'Stub', 'username': 'stub_bot'}
+
+
+class TelegramStub:
+    """Эмуляция методов Bot API, которые использует бот, с настраиваемой задержкой"""
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, bandwidth=0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        # Пропускная способность канала до Telegram, байт/с (0 — без ограничения): загрузка фото ждёт size/bandwidth
+        self.bandwidth = bandwidth
+        self._ids = itertools.count(1)
+        # Журнал вызовов: (monotonic время, метод, chat_id)
+        self.log = []
+        # Тексты сообщений и подписей: (chat_id, текст)
+        self.texts = []
+        self._changed = asyncio.Event()
+        # Апдейты, которые отдаст следующий getUpdates (для запуска бота через run_polling)
+        self.updates = []
+        self._runner = None
+
+    @property
+    def base_url(self):
+        """Для telegram.Bot(base_url=...): токен дописывается к этому префиксу"""
+        return f"http://{self.host}:{self.port}/bot"
+
+    async def start(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def _message(self, chat_id, **extra):
+        message = {
+            'message_id': next(self._ids),
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'},
+            'from': BOT_USER,
+        }
+        message.update(extra)
+        return message
+
+    def _file(self, sent=None, **extra):
+        # Отправка по file_id возвращает тот же file_id, загрузка файла — новый
+        file_id = sent if isinstance(sent, str) else f"file{next(self._ids)}"
+        return dict(extra, file_id=file_id, file_unique_id=file_id)
+
+    def _photo(self, sent=None):
+        return [self._file(sent, width=1280, height=640)]
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        if request.content_type.startswith('multipart/') or request.content_type == 'application/x-www-form-urlencoded':
+            params = await request.post()
+        elif request.can_read_body:
+            params = await request.json()
+        else:
+            params = {}
+        chat_id = params.get('chat_id')
+        self.log.append((time.monotonic(), method, int(chat_id) if chat_id else None))
+        self._changed.set()
+        self._changed = asyncio.Event()
+        text = params.get('text') or params.get('caption')
+        if chat_id and text:
+            self.texts.append((int(chat_id), text))
+
+        delay = self.latency + random.uniform(0, self.jitter)
+        if self.bandwidth and request.content_length:
+            delay += request.content_length / self.bandwidth
+        if delay:
+            await asyncio.sleep(delay)
+
+        if method == 'getMe':
+            result = BOT_USER
+        elif method == 'getUpdates':
+            if not self.updates:
+                # Long polling: без апдейтов держим запрос, но недолго, чтобы бот быстро останавливался
+                await asyncio.sleep(min(float(params.get('timeout') or 0), 0.5))
+            result, self.updates = self.updates, []
+        elif method in ('sendChatAction', 'answerCallbackQuery', 'deleteWebhook', 'setMyCommands'):
+            result = True
+        elif method == 'sendMediaGroup':
+            size = params['media'].count('"type"') if isinstance(params['media'], str) else len(params['media'])
+            result = [self._message(chat_id, photo=self._photo()) for _ in range(size)]
+        elif method == 'editMessageText':
+            result = self._message(chat_id or 0, text=params.get('text', ''))
+        elif method == 'sendPhoto':
+            result = self._message(chat_id, photo=self._photo(params.get('photo')))
+        elif method == 'sendVoice':
+            result = self._message(chat_id, voice=self._file(params.get('voice'), duration=1))
+        elif method in ('sendMessage', 'sendAudio'):
+            result = self._message(chat_id, text=params.get('text', ''))
+        else:
+            return web.json_response({'ok': False, 'error_code': 404, 'description': f'Not Found: {method}'}, status=404)
+        return web.json_response({'ok': True, 'result': result})
+
+    def calls_for(self, chat_id, since=0.0):
+        return [(t, m) for t, m, c in self.log if c == chat_id and t >= since]
+
+    async def wait_call(self, chat_id, since, methods):
+        """Дождаться вызова одного из methods в чат chat_id после since, вернуть его время"""
+        while True:
+            changed = self._changed
+            found = next((t for t, m in self.calls_for(chat_id, since) if m in methods), None)
+            if found is not None:
+                return found
+            await changed.wait()
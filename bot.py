@@ -1,68 +1,146 @@
+from __future__ import annotations
+
 import os
 import logging
-import tempfile
-import requests
-import aiohttp
 import asyncio
 import json
 import re
+import time
+from typing import TYPE_CHECKING
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import (
-    ApplicationBuilder, CommandHandler, CallbackQueryHandler, MessageHandler, ContextTypes, filters
-)
 from telegram.constants import ChatAction
+if TYPE_CHECKING:
+    # Только для аннотаций: telegram.ext импортируется в main()
+    from telegram.ext import ContextTypes
 import subprocess
+from llm_router import LLMRouter
+from resilience import (
+    BackendError, CircuitOpenError, call_backend, retry_async, backoff_delay, BREAKERS,
+    RETRY_ATTEMPTS, add_observer
+)
+from quality import QualityController, should_illustrate, MODE_TEXT_ONLY, MODE_ORDER
+from singleflight import SingleFlight, normalize_key
+from delivery import StoryDelivery, plan_album, delivery_snapshot
+from library import StoryLibrary
+from spool import MediaSpool
+import metrics
+import metering
+import imaging
+import scheduler
 
 # Загружаем переменные из .env файла
 load_dotenv()
 
 # --- Конфиг ---
 NEUROAPI_API_KEY = os.getenv('NEUROAPI_API_KEY')
-NEUROAPI_URL = 'https://neuroapi.host/v1/chat/completions'
-MODEL = 'gemini-2.5-pro'
+NEUROAPI_URL = os.getenv('NEUROAPI_URL', 'https://neuroapi.host/v1/chat/completions')
+
+# Маршрутизатор LLM с хеджированием медленных ответов (модели настраиваются в llm_router.py)
+llm_router = LLMRouter(NEUROAPI_URL, NEUROAPI_API_KEY)
+
+# Адаптивное качество иллюстраций по живой латентности и ошибкам бэкендов
+quality_controller = QualityController()
+add_observer(quality_controller.observe)
+
+# Одинаковые одновременные запросы к Art и TTS разделяют одну операцию
+art_flights = SingleFlight('art')
+tts_flights = SingleFlight('tts')
+
+# Прошлые сказки пользователей: /library повторяет их без обращений к LLM, Art и TTS
+story_library = StoryLibrary()
+
+# Дневные расходы пользователей сохраняются на диск: бюджеты не обнуляются при перезапуске
+usage_store = metering.UsageStore()
+
+# Картинки и аудио перед отправкой: отдельный каталог, учёт ссылок, квота и удаление утечек
+media_spool = MediaSpool()
+
+# Telegram ID администраторов через запятую: им доступна команда /stats
+ADMIN_IDS = {int(x) for x in os.getenv('ADMIN_IDS', '').replace(' ', '').split(',') if x}
 
 folder_id = os.getenv('YC_FOLDER_ID') or os.getenv('YANDEX_FOLDER_ID')
-# iam_token теперь будет обновляться автоматически
-iam_token = None
+# IAM токен обновляется в фоне через yc CLI; YANDEX_IAM_TOKEN — статический токен без yc
+iam_token = os.getenv('YANDEX_IAM_TOKEN') or None
+# Сколько Art и TTS ждут токен, пока он получается в фоне при запуске, секунды
+IAM_TOKEN_WAIT = float(os.getenv('IAM_TOKEN_WAIT', '25'))
+IAM_TOKEN_REFRESH_HOURS = float(os.getenv('IAM_TOKEN_REFRESH_HOURS', '24'))
+# Пауза перед повторной попыткой, если yc CLI не выдал токен
+IAM_TOKEN_RETRY_SECONDS = 60
 
 # Yandex Art API
-YANDEX_ART_URL = 'https://llm.api.cloud.yandex.net/foundationModels/v1/imageGenerationAsync'
-YANDEX_OPERATIONS_URL = 'https://llm.api.cloud.yandex.net/operations'
+YANDEX_ART_URL = os.getenv('YANDEX_ART_URL', 'https://llm.api.cloud.yandex.net/foundationModels/v1/imageGenerationAsync')
+YANDEX_OPERATIONS_URL = os.getenv('YANDEX_OPERATIONS_URL', 'https://llm.api.cloud.yandex.net/operations')
+# Интервал опроса асинхронной операции, секунды (общий таймаут задаёт quality_controller)
+ART_POLL_INTERVAL = float(os.getenv('ART_POLL_INTERVAL', '10'))
+
+# Адрес Bot API (по умолчанию api.telegram.org), например для локальной заглушки
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+
+# Yandex SpeechKit
+YANDEX_TTS_URL = os.getenv('YANDEX_TTS_URL', 'https://tts.api.cloud.yandex.net/speech/v1/tts:synthesize')
 
 # --- Получение IAM токена через yc CLI ---
-def fetch_iam_token():
+async def fetch_iam_token():
     try:
-        result = subprocess.run(['yc', 'iam', 'create-token'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=20)
-        if result.returncode == 0:
-            token = result.stdout.strip()
+        with metrics.span('token_fetch'):
+            proc = await asyncio.create_subprocess_exec(
+                'yc', 'iam', 'create-token', stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            )
+            try:
+                stdout, stderr = await asyncio.wait_for(proc.communicate(), 20)
+            except BaseException:
+                # Таймаут или остановка бота: не оставляем yc висеть
+                proc.kill()
+                await proc.wait()
+                raise
+        if proc.returncode == 0:
+            token = stdout.decode().strip()
             if token:
                 logging.info('IAM токен успешно получен через yc CLI')
                 return token
             else:
                 logging.error('Пустой IAM токен от yc CLI')
         else:
-            logging.error(f'Ошибка yc CLI: {result.stderr}')
+            logging.error(f'Ошибка yc CLI: {stderr.decode()}')
     except Exception as e:
         logging.error(f'Ошибка получения IAM токена: {e}')
     return None
 
-# --- Планировщик для обновления токена ---
-from apscheduler.schedulers.background import BackgroundScheduler
-import threading
-import pytz
+# --- Фоновое обновление токена ---
+# yc CLI отвечает до 20 секунд: бот не ждёт его при запуске, а Art и TTS ждут готовности токена
+_iam_token_ready = asyncio.Event()
+_iam_token_task = None
 
-def schedule_iam_token_update():
+async def refresh_iam_token_loop():
+    """Получить токен сразу, затем обновлять раз в IAM_TOKEN_REFRESH_HOURS"""
     global iam_token
-    def update_token():
-        global iam_token
-        token = fetch_iam_token()
+    while True:
+        token = await fetch_iam_token()
         if token:
             iam_token = token
-    update_token()  # Получить токен при запуске
-    scheduler = BackgroundScheduler(timezone=pytz.UTC)
-    scheduler.add_job(update_token, 'interval', hours=24)
-    scheduler.start()
+            _iam_token_ready.set()
+            await asyncio.sleep(IAM_TOKEN_REFRESH_HOURS * 3600)
+        else:
+            await asyncio.sleep(IAM_TOKEN_RETRY_SECONDS)
+
+def start_iam_token_refresh():
+    """Запустить фоновое обновление токена, если оно ещё не запущено"""
+    global _iam_token_task
+    if _iam_token_task is None or _iam_token_task.done():
+        _iam_token_task = asyncio.create_task(refresh_iam_token_loop())
+    return _iam_token_task
+
+async def get_iam_token(wait=IAM_TOKEN_WAIT):
+    """Текущий IAM токен; пока его нет — ждём фоновое получение не дольше wait секунд"""
+    if iam_token:
+        return iam_token
+    start_iam_token_refresh()
+    try:
+        await asyncio.wait_for(_iam_token_ready.wait(), wait)
+    except asyncio.TimeoutError:
+        logging.warning(f"IAM токен не получен за {wait:.0f}с")
+    return iam_token
 
 # --- Логирование ---
 logging.basicConfig(level=logging.INFO)
@@ -114,6 +192,14 @@ USER_STORY = {}
 USER_IMAGE_CONTEXT = {}
 
 # --- Хелперы ---
+def choose_story_mode(state):
+    """Режим иллюстраций: по состоянию бэкендов, но не выше ограничения бюджета пользователя"""
+    mode = quality_controller.choose_mode(state['length'])
+    cap = state.get('mode_cap')
+    if cap and MODE_ORDER.index(cap) < MODE_ORDER.index(mode):
+        return cap
+    return mode
+
 def build_keyboard(options):
     keyboard = [[InlineKeyboardButton(text, callback_data=val)] for text, val in options]
     return InlineKeyboardMarkup(keyboard)
@@ -125,7 +211,8 @@ def reset_user(user_id):
         'place': None,
         'mood': None,
         'age': None,
-        'length': None
+        'length': None,
+        'mode_cap': None
     }
     # Очищаем контекст изображений для нового пользователя
     if user_id in USER_IMAGE_CONTEXT:
@@ -152,20 +239,16 @@ def get_prompt(state):
         f"Не используй символы разметки или HTML, только текст сказки."
     )
 
-def generate_story(prompt):
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {NEUROAPI_API_KEY}"
-    }
+async def generate_story(prompt):
     data = {
-        "model": MODEL,
         "messages": [
             {"role": "user", "content": prompt}
         ]
     }
-    resp = requests.post(NEUROAPI_URL, headers=headers, json=data, timeout=300)
-    resp.raise_for_status()
-    return resp.json()['choices'][0]['message']['content']
+    with metrics.span('story_llm'):
+        result = await llm_router.complete('story', data)
+    logging.info(f"Сказка сгенерирована моделью {result['_routed_model']}")
+    return result['choices'][0]['message']['content']
 
 # --- Генерация изображений ---
 def init_image_context(user_id, state):
@@ -253,13 +336,7 @@ async def generate_ai_image_prompt(user_id, state, text_part=None, is_initial=Fa
 
 ПРОМПТ:"""
 
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {NEUROAPI_API_KEY}"
-        }
-        
         data = {
-            "model": "gpt-4o-mini",  # Переключаемся на более стабильную модель
             "messages": [
                 {"role": "system", "content": "Ты создаешь короткие промпты для детских иллюстраций. Отвечай ТОЛЬКО промптом, начинающимся с 'детская книжная иллюстрация:'. Никаких рассуждений или объяснений."},
                 {"role": "user", "content": ai_prompt}
@@ -270,46 +347,36 @@ async def generate_ai_image_prompt(user_id, state, text_part=None, is_initial=Fa
         }
         
         logging.info("Генерируем AI промпт для изображения...")
-        logging.info(f"Отправляем AI простой запрос: {ai_prompt}")
+        if metrics.should_log_payload():
+            logging.info(f"Отправляем AI простой запрос: {ai_prompt}")
+        
+        with metrics.span('prompt_llm'):
+            result = await llm_router.complete('prompt', data)
+        if metrics.should_log_payload():
+            logging.info(f"AI result: {result}")
+        
+        ai_generated_prompt = result['choices'][0]['message']['content'].strip()
+        logging.info(f"AI ({result['_routed_model']}) вернул промпт: '{ai_generated_prompt}'")
+        
+        # Проверяем что промпт не пустой
+        if not ai_generated_prompt or len(ai_generated_prompt.strip()) < 10:
+            logging.warning(f"AI вернул пустой промпт, используем fallback")
+            raise Exception("Empty AI prompt")
+        
+        # Убеждаемся что промпт начинается правильно
+        if not ai_generated_prompt.lower().startswith('детская книжная иллюстрация'):
+            if ai_generated_prompt.lower().startswith('иллюстрация'):
+                ai_generated_prompt = "детская книжная " + ai_generated_prompt
+            else:
+                ai_generated_prompt = "детская книжная иллюстрация: " + ai_generated_prompt
+        
+        # Обновляем контекст
+        scene_summary = current_text[:100] + "..." if len(current_text) > 100 else current_text
+        update_image_context(user_id, text_part, scene_summary)
+        
+        logging.info(f"Финальный AI промпт: {ai_generated_prompt}")
+        return ai_generated_prompt
         
-        async with aiohttp.ClientSession() as session:
-            async with session.post(NEUROAPI_URL, headers=headers, json=data) as resp:
-                logging.info(f"Статус ответа от AI: {resp.status}")
-                
-                if resp.status != 200:
-                    error_text = await resp.text()
-                    logging.error(f"Ошибка AI промпта (status {resp.status}): {error_text}")
-                    raise Exception(f"AI prompt error: {error_text}")
-                
-                result = await resp.json()
-                logging.info(f"AI result: {result}")
-                
-                if 'choices' not in result or len(result['choices']) == 0:
-                    logging.error(f"Неожиданная структура ответа AI: {result}")
-                    raise Exception("Invalid AI response structure")
-                
-                ai_generated_prompt = result['choices'][0]['message']['content'].strip()
-                logging.info(f"AI вернул промпт: '{ai_generated_prompt}'")
-                
-                # Проверяем что промпт не пустой
-                if not ai_generated_prompt or len(ai_generated_prompt.strip()) < 10:
-                    logging.warning(f"AI вернул пустой промпт, используем fallback")
-                    raise Exception("Empty AI prompt")
-                
-                # Убеждаемся что промпт начинается правильно
-                if not ai_generated_prompt.lower().startswith('детская книжная иллюстрация'):
-                    if ai_generated_prompt.lower().startswith('иллюстрация'):
-                        ai_generated_prompt = "детская книжная " + ai_generated_prompt
-                    else:
-                        ai_generated_prompt = "детская книжная иллюстрация: " + ai_generated_prompt
-                
-                # Обновляем контекст
-                scene_summary = current_text[:100] + "..." if len(current_text) > 100 else current_text
-                update_image_context(user_id, text_part, scene_summary)
-                
-                logging.info(f"Финальный AI промпт: {ai_generated_prompt}")
-                return ai_generated_prompt
-                
     except Exception as e:
         logging.error(f"Ошибка генерации AI промпта: {e}")
         # Fallback к контекстному методу
@@ -383,41 +450,78 @@ def create_image_prompt_fallback(state, text_part=None):
         mood_desc = mood_map.get(state['mood'], 'добрая атмосфера')
         return f"детская книжная иллюстрация: {state['hero']} в месте {state['place']}, {mood_desc}, яркие цвета, стиль детской книги"
 
-async def generate_image(prompt_text):
-    """Генерация изображения через Yandex Art API с универсальной обработкой данных"""
+async def generate_image(prompt_text, timeout=None):
+    """Генерация изображения через Yandex Art API с универсальной обработкой данных.
+    Возвращает ссылку на файл в спуле (SpoolFile) или None"""
     logging.info(f"Начинаем генерацию изображения для промпта: {prompt_text}")
+    if timeout is None:
+        timeout = quality_controller.art_timeout()
     
     try:
-        global iam_token
-        if not iam_token:
-            iam_token = fetch_iam_token()
-            if not iam_token:
-                raise Exception('Не удалось получить IAM токен для генерации изображения')
-        
-        headers = {
-            'Authorization': f'Bearer {iam_token}',
-            'Content-Type': 'application/json'
-        }
-        
-        data = {
-            "modelUri": f"art://{folder_id}/yandex-art/latest",
-            "generationOptions": {
-                "seed": str(hash(prompt_text) % 10000),
-                "aspectRatio": {
-                    "widthRatio": "2",
-                    "heightRatio": "1"
-                }
-            },
-            "messages": [
-                {
-                    "text": prompt_text
-                }
-            ]
-        }
-        
-        logging.info(f"Отправляем запрос на генерацию изображения: {prompt_text[:100]}...")
-        
-        async with aiohttp.ClientSession() as session:
+        # Без токена Art недоступен: сказка продолжается без картинки
+        if not await get_iam_token():
+            raise CircuitOpenError('iam')
+        # Ключ — нормализованный промпт: seed тоже выводится из промпта, запросы идентичны
+        key = normalize_key('art', prompt_text)
+        # Операция общая для всех ожидающих: картинку начисляет себе каждый, кто её получил
+        with metering.shared_scope():
+            image = await art_flights.do(key, _art_image, prompt_text, timeout)
+        if not image:
+            return None
+        metering.charge_image()
+        # Ожидающие одного промпта делят файл спула, у каждого своя ссылка: освобождается после отправки
+        with metrics.span('image_save'):
+            return await save_image_data(image, "изображение", key)
+    except CircuitOpenError as e:
+        logging.warning(f"Пропускаем изображение: {e}")
+        return None
+    except Exception as e:
+        logging.error(f"Ошибка генерации изображения: {e}")
+        logging.error(f"Тип ошибки: {type(e).__name__}")
+        import traceback
+        logging.error(f"Трассировка: {traceback.format_exc()}")
+        return None
+
+async def _art_image(prompt_text, timeout):
+    """Операция Art и подготовка картинки — один раз на всех ожидающих одинакового промпта"""
+    # Не больше ART_CONCURRENCY операций сразу, очередь делится между пользователями по кругу
+    image_data = await scheduler.run_background(
+        'art', call_backend, 'art', _generate_image, prompt_text, timeout, retry=False
+    )
+    with metrics.span('image_prepare'):
+        return await prepare_image_data(image_data, "изображение")
+
+async def _generate_image(prompt_text, timeout):
+    """Один проход генерации: отправка операции с повторами и опрос до готовности.
+    Возвращает данные изображения (bytes, base64 или URL) для prepare_image_data"""
+    import aiohttp
+    # timeout — на всю генерацию: повторы отправки тоже расходуют его
+    deadline = time.monotonic() + timeout
+    headers = {
+        'Authorization': f'Bearer {iam_token}',
+        'Content-Type': 'application/json'
+    }
+    
+    data = {
+        "modelUri": f"art://{folder_id}/yandex-art/latest",
+        "generationOptions": {
+            "seed": str(hash(prompt_text) % 10000),
+            "aspectRatio": {
+                "widthRatio": "2",
+                "heightRatio": "1"
+            }
+        },
+        "messages": [
+            {
+                "text": prompt_text
+            }
+        ]
+    }
+    
+    logging.info(f"Отправляем запрос на генерацию изображения: {prompt_text[:100]}...")
+    
+    async with aiohttp.ClientSession() as session:
+        async def submit():
             async with session.post(YANDEX_ART_URL, headers=headers, json=data) as resp:
                 logging.info(f"Статус ответа API: {resp.status}")
                 logging.info(f"Content-Type: {resp.headers.get('Content-Type', 'unknown')}")
@@ -425,77 +529,92 @@ async def generate_image(prompt_text):
                 if resp.status != 200:
                     error_text = await resp.text()
                     logging.error(f"Art API error (status {resp.status}): {error_text}")
-                    raise Exception(f"Art API error (status {resp.status}): {error_text}")
+                    raise BackendError(f"Art API error (status {resp.status}): {error_text}", resp.status)
                 
                 # Проверяем тип контента
                 content_type = resp.headers.get('Content-Type', '').lower()
                 if 'image' in content_type or 'application/octet-stream' in content_type:
                     # API вернул изображение напрямую (синхронный режим)
                     logging.info("API вернул изображение напрямую (синхронный режим)")
-                    image_data = await resp.read()
-                    logging.info(f"Размер полученного изображения: {len(image_data)} байт")
-                    
-                    # Используем универсальную функцию сохранения
-                    return await save_image_data(image_data, "синхронное изображение")
+                    return await resp.read(), None
+                
+                # API вернул JSON с operation_id (асинхронный режим)
+                result = await resp.json()
+                if metrics.should_log_payload():
+                    logging.info(f"Ответ API (JSON): {result}")
+                return None, result['id']
+        
+        with metrics.span('art_submit'):
+            image_data, operation_id = await retry_async(submit, name='art submit')
+        if image_data is not None:
+            logging.info(f"Размер полученного изображения: {len(image_data)} байт")
+            metering.record_image()
+            return image_data
+        
+        logging.info(f"Получен operation_id: {operation_id}")
+        
+        # Ждем завершения генерации
+        check_url = f"{YANDEX_OPERATIONS_URL}/{operation_id}"
+        logging.info(f"Проверяем статус операции по URL: {check_url}")
+        
+        with metrics.span('art_poll'):
+            image_data = await _poll_art_operation(session, check_url, headers, deadline)
+        metering.record_image()
+        return image_data
+
+async def _poll_art_operation(session, check_url, headers, deadline):
+    """Опрос асинхронной операции Art до готовности или дедлайна (time.monotonic())"""
+    poll_errors = 0
+    attempt = 0
+    while time.monotonic() < deadline:
+        attempt += 1
+        # Временные ошибки опроса увеличивают паузу перед следующей проверкой; последняя — ровно к дедлайну
+        delay = ART_POLL_INTERVAL + (backoff_delay(poll_errors) if poll_errors else 0)
+        await asyncio.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+        logging.info(f"Попытка {attempt} проверки статуса, до дедлайна {max(0.0, deadline - time.monotonic()):.0f}с...")
+        
+        async with session.get(check_url, headers=headers) as check_resp:
+            if check_resp.status != 200:
+                error_text = await check_resp.text()
+                logging.error(f"Ошибка проверки статуса (status {check_resp.status}): {error_text}")
+                error = BackendError(f"Art operation error (status {check_resp.status}): {error_text}", check_resp.status)
+                poll_errors += 1
+                if not error.retryable or poll_errors >= RETRY_ATTEMPTS * 2:
+                    raise error
+                continue
+            poll_errors = 0
+                
+            # Готовая операция несёт картинку в base64 на несколько мегабайт — разбираем JSON в пуле потоков
+            check_result = await scheduler.run_blocking(json.loads, await check_resp.read())
+            if metrics.should_log_payload():
+                logging.info(f"Статус операции: {json.dumps(check_result, ensure_ascii=False)}")
+            else:
+                logging.info(f"Статус операции: done={check_result.get('done', False)}")
+            
+            if check_result.get('done'):
+                logging.info("Операция завершена! Анализируем результат...")
+                
+                if 'error' in check_result:
+                    logging.error(f"Ошибка в результате: {check_result['error']}")
+                    raise Exception(f"Art generation error: {check_result['error']}")
+                
+                if 'response' in check_result:
+                    response_data = check_result['response']
+                    logging.info(f"Найден блок response с ключами: {list(response_data.keys())}")
                     
+                    if 'image' in response_data:
+                        image_data = response_data['image']
+                        logging.info(f"Найдено поле image! Тип: {type(image_data)}")
+                        return image_data
+                    else:
+                        logging.error(f"Нет поля image в response! Ключи: {list(response_data.keys())}")
+                        raise Exception(f"Неожиданный формат ответа: {check_result}")
                 else:
-                    # API вернул JSON с operation_id (асинхронный режим)
-                    response_text = await resp.text()
-                    logging.info(f"Ответ API (JSON): {response_text}")
-                    
-                    result = await resp.json()
-                    operation_id = result['id']
-                    logging.info(f"Получен operation_id: {operation_id}")
-                    
-                    # Ждем завершения генерации
-                    check_url = f"{YANDEX_OPERATIONS_URL}/{operation_id}"
-                    logging.info(f"Проверяем статус операции по URL: {check_url}")
-                    
-                    for attempt in range(30):  # максимум 30 попыток (5 минут)
-                        await asyncio.sleep(10)
-                        logging.info(f"Попытка {attempt + 1}/30 проверки статуса...")
-                        
-                        async with session.get(check_url, headers=headers) as check_resp:
-                            if check_resp.status != 200:
-                                error_text = await check_resp.text()
-                                logging.error(f"Ошибка проверки статуса (status {check_resp.status}): {error_text}")
-                                continue
-                                
-                            check_result = await check_resp.json()
-                            logging.info(f"Статус операции: {json.dumps(check_result, ensure_ascii=False)}")
-                            
-                            if check_result.get('done'):
-                                logging.info("Операция завершена! Анализируем результат...")
-                                
-                                if 'error' in check_result:
-                                    logging.error(f"Ошибка в результате: {check_result['error']}")
-                                    raise Exception(f"Art generation error: {check_result['error']}")
-                                
-                                if 'response' in check_result:
-                                    response_data = check_result['response']
-                                    logging.info(f"Найден блок response с ключами: {list(response_data.keys())}")
-                                    
-                                    if 'image' in response_data:
-                                        image_data = response_data['image']
-                                        logging.info(f"Найдено поле image! Тип: {type(image_data)}")
-                                        
-                                        # Используем универсальную функцию сохранения
-                                        return await save_image_data(image_data, "асинхронное изображение")
-                                    else:
-                                        logging.error(f"Нет поля image в response! Ключи: {list(response_data.keys())}")
-                                        raise Exception(f"Неожиданный формат ответа: {check_result}")
-                                else:
-                                    logging.error("Нет блока response в результате!")
-                                    raise Exception(f"Неожиданный формат ответа: {check_result}")
-                    
-                    raise Exception("Timeout waiting for image generation")
+                    logging.error("Нет блока response в результате!")
+                    raise Exception(f"Неожиданный формат ответа: {check_result}")
     
-    except Exception as e:
-        logging.error(f"Ошибка генерации изображения: {e}")
-        logging.error(f"Тип ошибки: {type(e).__name__}")
-        import traceback
-        logging.error(f"Трассировка: {traceback.format_exc()}")
-        return None
+    raise Exception("Timeout waiting for image generation")
+
 
 def split_story_into_sentences(story):
     """Разделить сказку на части по ~10 предложений"""
@@ -518,9 +637,13 @@ def split_story_into_sentences(story):
     
     return parts
 
-async def save_image_data(image_data, description="image"):
-    """Универсальная функция для сохранения данных изображения в временный файл"""
-    logging.info(f"Сохраняем {description}, тип данных: {type(image_data)}")
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+async def prepare_image_data(image_data, description="image"):
+    """Данные изображения (bytes, base64 или URL) -> (bytes, суффикс файла), пережатые под фото Telegram"""
+    logging.info(f"Готовим {description}, тип данных: {type(image_data)}")
     
     try:
         # Определяем тип данных и преобразуем в bytes
@@ -528,12 +651,11 @@ async def save_image_data(image_data, description="image"):
             if image_data.startswith('http'):
                 # Это URL - скачиваем изображение
                 logging.info(f"Обнаружен URL: {image_data}")
-                return await download_image(image_data)
+                binary_data = await download_image(image_data)
             else:
-                # Это base64 - декодируем
-                logging.info("Обнаружены base64 данные, декодируем...")
-                import base64
-                binary_data = base64.b64decode(image_data)
+                # Это base64 - декодирует imaging.optimize в процессе-воркере вместе с перекодированием
+                logging.info("Обнаружены base64 данные")
+                binary_data = image_data
         elif isinstance(image_data, (bytes, bytearray)):
             # Уже бинарные данные
             logging.info("Обнаружены бинарные данные")
@@ -547,21 +669,23 @@ async def save_image_data(image_data, description="image"):
             logging.error("Пустые данные изображения")
             return None
         
-        logging.info(f"Размер данных для сохранения: {len(binary_data)} байт")
+        logging.info(f"Размер данных изображения: {len(binary_data)} байт")
         
-        # Создаем временный файл
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as f:
-            f.write(binary_data)
-            f.flush()
-            temp_path = f.name
-            
-        # Проверяем что файл создан успешно
-        if os.path.exists(temp_path) and os.path.getsize(temp_path) > 0:
-            logging.info(f"{description} сохранено успешно: {temp_path}, размер: {os.path.getsize(temp_path)} байт")
-            return temp_path
-        else:
-            logging.error(f"Файл не создан или пустой: {temp_path}")
-            return None
+        # Уменьшаем и пережимаем под фото Telegram (в отдельных процессах, не блокируя цикл событий)
+        return await imaging.optimize(binary_data)
+    
+    except Exception as e:
+        logging.error(f"Ошибка подготовки {description}: {e}")
+        return None
+
+async def save_image_data(image, description="image", key=None):
+    """Сохранить подготовленное изображение (bytes, суффикс) в спул, вернуть ссылку на файл.
+    Вызывающий код освобождает ссылку после отправки"""
+    binary_data, suffix = image
+    try:
+        handle = await media_spool.write(binary_data, suffix, key=key)
+        logging.info(f"{description} сохранено успешно: {handle.path}, размер: {handle.size} байт")
+        return handle
             
     except Exception as e:
         logging.error(f"Ошибка сохранения {description}: {e}")
@@ -569,6 +693,7 @@ async def save_image_data(image_data, description="image"):
 
 async def download_image(image_url):
     """Скачать изображение по URL"""
+    import aiohttp
     logging.info(f"Скачиваем изображение с URL: {image_url}")
     try:
         async with aiohttp.ClientSession() as session:
@@ -576,9 +701,7 @@ async def download_image(image_url):
                 if resp.status == 200:
                     content = await resp.read()
                     logging.info(f"Размер скачанного изображения: {len(content)} байт")
-                    
-                    # Используем универсальную функцию сохранения
-                    return await save_image_data(content, "скачанное изображение")
+                    return content
                 else:
                     error_text = await resp.text()
                     logging.error(f"Ошибка скачивания изображения (status {resp.status}): {error_text}")
@@ -587,7 +710,86 @@ async def download_image(image_url):
         logging.error(f"Исключение при скачивании изображения: {e}")
         return None
 
+async def deliver_story_album(delivery, user_id, state, story_parts):
+    """Доставка сказки альбомами: промпты по порядку, картинки параллельно, текст частей в подписях.
+    Части уходят в чат, как только готовы их картинки: готовые подряд части
+    собираются в один альбом. Возвращает промпты иллюстраций (None для частей без картинки)"""
+    await delivery.chat_action("upload_photo")
+    mode = choose_story_mode(state)
+    prompts = [None] * len(story_parts)
+    
+    async def next_prompt(previous, i, part):
+        # Промпты строятся последовательно: каждый учитывает сцены предыдущих частей
+        if previous is not None:
+            await asyncio.wait({previous})
+        prompts[i] = await generate_ai_image_prompt(user_id, state, part)
+        return prompts[i]
+    
+    async def illustrate(i, prompt_task):
+        try:
+            image_prompt = await prompt_task
+            logging.info(f"Генерируем AI изображение для части {i+1}: {image_prompt[:100]}...")
+            image = await generate_image(image_prompt)
+            if not image:
+                logging.error(f"Не удалось скачать изображение для части {i+1}")
+                return None
+            with image:
+                return await scheduler.run_blocking(read_file, image.path)
+        except Exception as e:
+            logging.error(f"Ошибка генерации изображения для части {i+1}: {e}")
+            return None
+    
+    # Картинка части начинает генерироваться, как только готов её промпт; картинки не ждут друг друга
+    tasks = []
+    previous = None
+    for i, part in enumerate(story_parts):
+        if should_illustrate(mode, i, len(story_parts)):
+            previous = asyncio.ensure_future(next_prompt(previous, i, part))
+            tasks.append(asyncio.ensure_future(illustrate(i, previous)))
+        else:
+            tasks.append(None)
+    
+    try:
+        sent = 0
+        while sent < len(story_parts):
+            # Ждём картинку следующей по порядку части (статус "загружает фото" не гаснет)...
+            if tasks[sent] is not None:
+                await delivery.wait(asyncio.wait({tasks[sent]}), "upload_photo")
+            # ...и забираем все готовые подряд части одним шагом
+            ready = sent
+            while ready < len(story_parts) and (tasks[ready] is None or tasks[ready].done()):
+                ready += 1
+            images = [task.result() if task is not None else None for task in tasks[sent:ready]]
+            steps = plan_album(story_parts[sent:ready], images, start=sent, total=len(story_parts))
+            sent = ready
+            for kind, payload in steps:
+                if kind == 'text':
+                    await delivery.send_message(payload)
+                    continue
+                try:
+                    await delivery.send_album(payload)
+                except Exception as send_error:
+                    # Альбом не ушёл — текст сказки всё равно должен дойти
+                    logging.error(f"Ошибка отправки альбома в Telegram: {send_error}")
+                    for _, caption in payload:
+                        if not caption.startswith("🎨"):
+                            await delivery.send_message(caption)
+    finally:
+        # Сказку прервали (остановка бота): незаконченные промпты и картинки больше не нужны
+        for task in tasks:
+            if task is not None and not task.done():
+                task.cancel()
+    return prompts
+
 # --- Хэндлеры ---
+RESTARTING_TEXT = "Бот перезапускается. Попробуйте, пожалуйста, через минуту."
+STORY_BUSY_TEXT = "Сказка ещё рассказывается. Дождись конца и нажми кнопку ещё раз 🙂"
+# Фоновые задачи, которые рассказывают сказку: у пользователя одновременно не больше одной
+STORY_JOBS = ('story', 'replay')
+
+async def reply_restarting(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(RESTARTING_TEXT)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     reset_user(user_id)
@@ -600,7 +802,8 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "Этот бот поможет придумать сказку на ночь с красивыми иллюстрациями! " \
         "Используй /new чтобы начать заново. " \
-        "Используй /audio, чтобы получить аудиофайл сказки."
+        "Используй /audio, чтобы получить аудиофайл сказки. " \
+        "Используй /library, чтобы снова послушать прошлые сказки."
     )
 
 async def new_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -610,6 +813,19 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
+    if scheduler.is_draining() and (query.data.startswith('lib:') or USER_STATE.get(user_id, {}).get('step') == 'length'):
+        # Бот останавливается: новые сказки не начинаем, чтобы не обрывать их на середине
+        await query.edit_message_text(RESTARTING_TEXT)
+        return
+    if (query.data.startswith('lib:') or USER_STATE.get(user_id, {}).get('step') == 'length') \
+            and scheduler.jobs_for(user_id, *STORY_JOBS):
+        # Параллельные сказки делят контекст иллюстраций пользователя и обходят дневной бюджет.
+        # Клавиатура остаётся на месте: после окончания сказки кнопку можно нажать снова
+        await query.message.reply_text(STORY_BUSY_TEXT)
+        return
+    if query.data.startswith('lib:'):
+        scheduler.spawn(user_id, replay_story(query, context, user_id, int(query.data[4:])), 'replay')
+        return
     state = USER_STATE.get(user_id)
     if not state:
         reset_user(user_id)
@@ -618,150 +834,251 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     step = state['step']
     data = query.data
 
-    if step == 'hero':
-        if data == 'custom':
-            state['step'] = 'hero_custom'
-            await query.edit_message_text("Введи имя главного героя:")
-            return
-        state['hero'] = data
-        state['step'] = 'place'
-        await query.edit_message_text(
-            "Где будет происходить действие?",
-            reply_markup=build_keyboard(PLACES)
-        )
-    elif step == 'place':
-        if data == 'custom':
-            state['step'] = 'place_custom'
-            await query.edit_message_text("Введи место действия:")
-            return
-        state['place'] = data
-        state['step'] = 'mood'
-        await query.edit_message_text(
-            "Какое настроение у сказки?",
-            reply_markup=build_keyboard(MOODS)
-        )
-    elif step == 'mood':
-        state['mood'] = data
-        state['step'] = 'age'
-        await query.edit_message_text(
-            "Для кого эта сказка?",
-            reply_markup=build_keyboard(AGES)
-        )
-    elif step == 'age':
-        state['age'] = data
-        state['step'] = 'length'
-        await query.edit_message_text(
-            "Какой длины должна быть сказка?",
-            reply_markup=build_keyboard(LENGTHS)
-        )
-    elif step == 'length':
-        state['length'] = data
+    if step == 'length':
+        # Пользователь, исчерпавший дневной бюджет, получает сказку короче и с меньшим числом картинок
+        length, mode_cap = metering.budget_plan(user_id, data)
+        if length != data or mode_cap:
+            logging.info(f"Бюджет пользователя {user_id}: длина {data} -> {length}, иллюстрации не выше {mode_cap}")
+        state['length'] = length
+        state['mode_cap'] = mode_cap
         state['step'] = 'done'
+        # Генерация идёт фоновой задачей: хэндлер сразу освобождается для следующих апдейтов
+        scheduler.spawn(user_id, run_story(query, context, user_id, state), 'story')
+        return
+
+    # Переходы по клавиатуре должны отвечать мгновенно — меряем их отдельно от генерации
+    with metrics.span('keyboard'):
+        if step == 'hero':
+            if data == 'custom':
+                state['step'] = 'hero_custom'
+                await query.edit_message_text("Введи имя главного героя:")
+                return
+            state['hero'] = data
+            state['step'] = 'place'
+            await query.edit_message_text(
+                "Где будет происходить действие?",
+                reply_markup=build_keyboard(PLACES)
+            )
+        elif step == 'place':
+            if data == 'custom':
+                state['step'] = 'place_custom'
+                await query.edit_message_text("Введи место действия:")
+                return
+            state['place'] = data
+            state['step'] = 'mood'
+            await query.edit_message_text(
+                "Какое настроение у сказки?",
+                reply_markup=build_keyboard(MOODS)
+            )
+        elif step == 'mood':
+            state['mood'] = data
+            state['step'] = 'age'
+            await query.edit_message_text(
+                "Для кого эта сказка?",
+                reply_markup=build_keyboard(AGES)
+            )
+        elif step == 'age':
+            state['age'] = data
+            state['step'] = 'length'
+            await query.edit_message_text(
+                "Какой длины должна быть сказка?",
+                reply_markup=build_keyboard(LENGTHS)
+            )
+
+async def run_story(query, context, user_id, state):
+    story_started = time.monotonic()
+    with metrics.span('story_total'), metering.story_scope(user_id) as story_cost:
+        await generate_and_send_story(query, context, user_id, state)
+    metering.record_story(time.monotonic() - story_started, story_cost['cost'])
+
+async def generate_and_send_story(query, context, user_id, state):
+    """Полный цикл сказки: начальная картинка, текст от LLM, части с иллюстрациями"""
+    delivery = StoryDelivery(context.bot, query.message.chat_id)
+    # Ход генерации: при остановке бота посреди сказки по нему сохраняется прогресс
+    progress = {'story': None, 'parts': [], 'prompts': []}
+    try:
+        await _generate_and_send_story(query, context, user_id, state, delivery, progress)
+    except asyncio.CancelledError:
+        if scheduler.is_draining():
+            await checkpoint_story(delivery, user_id, state, progress)
+        raise
+
+async def checkpoint_story(delivery, user_id, state, progress):
+    """Остановка бота прервала сказку: уже оплаченный текст сохраняется в библиотеку
+    (отправленные шаги и недосказанные части), пользователь получает ссылку на /library"""
+    story = progress['story']
+    try:
+        if story:
+            sent = delivery.sent_texts()
+            steps = delivery.steps + [('text', part) for part in progress['parts'] if part not in sent]
+            params = {key: state[key] for key in ('hero', 'place', 'mood', 'age', 'length')}
+            state['story_id'] = await story_library.save(
+                user_id, story_title(state), story, params, progress['prompts'], steps
+            )
+            USER_STORY[user_id] = story
+            metrics.inc('stories_checkpointed')
+            await delivery.send_message("⏸ Бот перезапускается. Сказка сохранена — дослушать её можно через /library.")
+        else:
+            await delivery.send_message(RESTARTING_TEXT + " Сказку придётся начать заново: /start")
+    except Exception as e:
+        logging.error(f"Не удалось сохранить прерванную сказку пользователя {user_id}: {e}")
+
+async def _generate_and_send_story(query, context, user_id, state, delivery, progress):
+    # Режим иллюстраций выбирается по текущей латентности и ошибкам бэкендов
+    mode = choose_story_mode(state)
+    if mode == MODE_TEXT_ONLY:
+        await query.edit_message_text("Готовлю сказку...")
+    else:
         await query.edit_message_text("Готовлю сказку с изображениями...")
-        
-        # Показываем действие "печатает..."
-        await context.bot.send_chat_action(chat_id=query.message.chat_id, action="typing")
-        
-        # Генерируем первое изображение на основе параметров
+    
+    # Показываем действие "печатает..."
+    await delivery.chat_action("typing")
+    # Промпты иллюстраций сохраняются в библиотеку вместе со сказкой
+    prompts = progress['prompts']
+    
+    # Бэкенды перегружены или Art недоступен — сказка без начальной картинки
+    if mode == MODE_TEXT_ONLY:
+        logging.warning("Режим без иллюстраций, пропускаем начальное изображение")
+        await delivery.send_message("🎨 Начинаем сказку...")
+    else:
         try:
             initial_prompt = await generate_ai_image_prompt(user_id, state, is_initial=True)
+            prompts.append(initial_prompt)
             logging.info(f"Генерируем начальное изображение: {initial_prompt}")
-            await context.bot.send_chat_action(chat_id=query.message.chat_id, action="upload_photo")
-            
-            image_path = await generate_image(initial_prompt)
-            logging.info(f"Получен путь к изображению: {image_path}")
-            
-            if image_path:
-                logging.info(f"Отправляем изображение: {image_path}")
+            await delivery.chat_action("upload_photo")
+        
+            image = await delivery.wait(generate_image(initial_prompt), "upload_photo")
+            logging.info(f"Получено изображение: {image.path if image else None}")
+        
+            if image:
+                logging.info(f"Отправляем изображение: {image.path}")
                 try:
-                    with open(image_path, 'rb') as photo:
-                        await context.bot.send_photo(
-                            chat_id=query.message.chat_id, 
-                            photo=photo, 
-                            caption="🎨 Вот ваша сказка начинается..."
-                        )
+                    with image.open() as photo:
+                        await delivery.send_photo(photo, caption="🎨 Вот ваша сказка начинается...")
                         logging.info("Изображение успешно отправлено")
-                        
-                    # Удаляем временный файл
-                    try:
-                        os.unlink(image_path)
-                        logging.info(f"Временный файл удален: {image_path}")
-                    except Exception as e:
-                        logging.warning(f"Не удалось удалить временный файл {image_path}: {e}")
-                        
+                    
                 except Exception as send_error:
                     logging.error(f"Ошибка отправки изображения в Telegram: {send_error}")
-                    await context.bot.send_message(chat_id=query.message.chat_id, text="🎨 Начинаем сказку...")
+                    await delivery.send_message("🎨 Начинаем сказку...")
+                finally:
+                    # Освобождаем файл в спуле
+                    image.release()
             else:
                 logging.error("Не удалось скачать изображение")
-                await context.bot.send_message(chat_id=query.message.chat_id, text="🎨 Начинаем сказку...")
-                
+                await delivery.send_message("🎨 Начинаем сказку...")
+            
         except Exception as e:
             logging.error(f"Ошибка генерации начального изображения: {e}")
-            await context.bot.send_message(chat_id=query.message.chat_id, text="🎨 Начинаем сказку...")
-        
-        # Генерируем сказку
-        await context.bot.send_chat_action(chat_id=query.message.chat_id, action="typing")
-        prompt = get_prompt(state)
-        try:
-            story = generate_story(prompt)
-        except Exception as e:
-            await query.edit_message_text(f"Не удалось сгенерировать сказку, простите. Попробуйте позже.")
-            logging.error(f"Ошибка генерации сказки: {e}")
-            return
-        
-        # Разделяем сказку на части
-        story_parts = split_story_into_sentences(story)
-        await query.edit_message_text("Готово! Вот твоя сказка:")
-        
+            await delivery.send_message("🎨 Начинаем сказку...")
+    
+    # Генерируем сказку
+    await delivery.chat_action("typing")
+    prompt = get_prompt(state)
+    try:
+        story = progress['story'] = await delivery.wait(generate_story(prompt), "typing")
+    except Exception as e:
+        await query.edit_message_text(f"Не удалось сгенерировать сказку, простите. Попробуйте позже.")
+        logging.error(f"Ошибка генерации сказки: {e}")
+        return
+    
+    # Разделяем сказку на части
+    story_parts = progress['parts'] = split_story_into_sentences(story)
+    await query.edit_message_text("Готово! Вот твоя сказка:")
+    
+    if delivery.mode == 'album':
+        # Картинки с текстом в подписях, сгруппированные в альбомы
+        album_prompts = await deliver_story_album(delivery, user_id, state, story_parts)
+        prompts.extend(p for p in album_prompts if p)
+    else:
         # Отправляем каждую часть с изображением
         for i, part in enumerate(story_parts):
             # Отправляем текст части
-            await context.bot.send_message(chat_id=query.message.chat_id, text=part)
-            
+            await delivery.send_message(part)
+        
+            # Режим пересчитывается на каждой части: при деградации остаток идёт без картинок
+            mode = choose_story_mode(state)
+            if not should_illustrate(mode, i, len(story_parts)):
+                continue
+        
             # Генерируем изображение для каждой части (включая последнюю)
             try:
-                await context.bot.send_chat_action(chat_id=query.message.chat_id, action="upload_photo")
+                await delivery.chat_action("upload_photo")
                 image_prompt = await generate_ai_image_prompt(user_id, state, part)
+                prompts.append(image_prompt)
                 logging.info(f"Генерируем AI изображение для части {i+1}: {image_prompt[:100]}...")
-                image_path = await generate_image(image_prompt)
-                logging.info(f"Получен путь к изображению для части {i+1}: {image_path}")
-                
-                if image_path:
-                    logging.info(f"Отправляем изображение части {i+1}: {image_path}")
+                image = await delivery.wait(generate_image(image_prompt), "upload_photo")
+                logging.info(f"Получено изображение для части {i+1}: {image.path if image else None}")
+            
+                if image:
+                    logging.info(f"Отправляем изображение части {i+1}: {image.path}")
                     try:
                         # Определяем подпись для изображения
                         if i == len(story_parts) - 1:
                             caption = "🎨 Конец сказки"
                         else:
                             caption = f"🎨 Часть {i+2}"
-                            
-                        with open(image_path, 'rb') as photo:
-                            await context.bot.send_photo(
-                                chat_id=query.message.chat_id, 
-                                photo=photo, 
-                                caption=caption
-                            )
+                        
+                        with image.open() as photo:
+                            await delivery.send_photo(photo, caption=caption)
                             logging.info(f"Изображение части {i+1} успешно отправлено")
-                            
-                        # Удаляем временный файл
-                        try:
-                            os.unlink(image_path)
-                            logging.info(f"Временный файл части {i+1} удален: {image_path}")
-                        except Exception as e:
-                            logging.warning(f"Не удалось удалить временный файл {image_path}: {e}")
-                            
+                        
                     except Exception as send_error:
                         logging.error(f"Ошибка отправки изображения части {i+1} в Telegram: {send_error}")
+                    finally:
+                        # Освобождаем файл в спуле
+                        image.release()
                 else:
                     logging.error(f"Не удалось скачать изображение для части {i+1}")
-                    
+                
             except Exception as e:
                 logging.error(f"Ошибка генерации изображения для части {i+1}: {e}")
                 # Продолжаем без изображения
-        
-        # Сохраняем последнюю сказку пользователя
-        USER_STORY[user_id] = story
+    
+    # Сохраняем последнюю сказку пользователя
+    USER_STORY[user_id] = story
+    _, delivery_seconds = delivery.finish()
+    quality_controller.record_story(delivery_seconds)
+    
+    # И кладём её в библиотеку: текст, промпты и file_id отправленных картинок
+    try:
+        params = {key: state[key] for key in ('hero', 'place', 'mood', 'age', 'length')}
+        state['story_id'] = await story_library.save(
+            user_id, story_title(state), story, params, prompts, delivery.steps
+        )
+    except Exception as e:
+        logging.error(f"Не удалось сохранить сказку в библиотеку: {e}")
+
+def story_title(state):
+    return f"{state['hero']}, {state['place']}"
+
+# --- Библиотека сказок ---
+async def library_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    stories = await story_library.recent(user_id)
+    if not stories:
+        await update.message.reply_text("В библиотеке пока нет сказок. Создайте первую командой /start.")
+        return
+    options = [
+        (f"{time.strftime('%d.%m', time.localtime(s['created_at']))} {s['title']}"[:60], f"lib:{s['id']}")
+        for s in stories
+    ]
+    await update.message.reply_text("Какую сказку рассказать снова?", reply_markup=build_keyboard(options))
+
+async def replay_story(query, context, user_id, story_id):
+    """Повтор сказки из библиотеки: те же сообщения и картинки по file_id, без генерации"""
+    entry = await story_library.get(user_id, story_id)
+    if not entry:
+        await query.edit_message_text("Эта сказка не найдена в библиотеке.")
+        return
+    await query.edit_message_text(f"📚 {entry['title']}")
+    delivery = StoryDelivery(context.bot, query.message.chat_id)
+    with metrics.span('library_replay'):
+        await delivery.replay(entry['steps'])
+    metrics.inc('library_replays')
+    # /audio после повтора озвучивает эту сказку (или отправляет сохранённую озвучку)
+    USER_STORY[user_id] = entry['text']
+    reset_user(user_id)
+    USER_STATE[user_id].update(entry['params'], step='done', story_id=story_id)
 
 # --- Тестовая команда для отладки генерации изображений ---
 async def test_image_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -770,13 +1087,13 @@ async def test_image_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         test_prompt = "детская книжная иллюстрация: маленький дракончик в волшебном лесу, добрая атмосфера, яркие цвета"
         logging.info(f"Генерируем тестовое изображение: {test_prompt}")
-        image_path = await generate_image(test_prompt)
-        logging.info(f"Получен путь к тестовому изображению: {image_path}")
+        image = await generate_image(test_prompt)
+        logging.info(f"Получено тестовое изображение: {image.path if image else None}")
         
-        if image_path:
-            logging.info(f"Отправляем тестовое изображение: {image_path}")
+        if image:
+            logging.info(f"Отправляем тестовое изображение: {image.path}")
             try:
-                with open(image_path, 'rb') as photo:
+                with image.open() as photo:
                     await context.bot.send_photo(
                         chat_id=update.effective_chat.id, 
                         photo=photo, 
@@ -784,16 +1101,12 @@ async def test_image_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     )
                     logging.info("Тестовое изображение успешно отправлено")
                     
-                # Удаляем временный файл
-                try:
-                    os.unlink(image_path)
-                    logging.info(f"Временный тестовый файл удален: {image_path}")
-                except Exception as e:
-                    logging.warning(f"Не удалось удалить временный файл {image_path}: {e}")
-                    
             except Exception as send_error:
                 logging.error(f"Ошибка отправки тестового изображения в Telegram: {send_error}")
                 await update.message.reply_text(f"Изображение сгенерировано, но не отправлено: {send_error}")
+            finally:
+                # Освобождаем файл в спуле
+                image.release()
         else:
             logging.error("Не удалось скачать тестовое изображение")
             await update.message.reply_text("Не удалось скачать сгенерированное изображение")
@@ -802,30 +1115,104 @@ async def test_image_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"Ошибка генерации изображения: {e}")
         logging.error(f"Ошибка тестовой генерации изображения: {e}")
 
-# --- Команда для проверки конфигурации ---
-async def debug_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global iam_token
-    debug_info = []
+# --- Команда /stats: метрики и состояние бэкендов (только для админов) ---
+def is_admin(user_id):
+    return user_id in ADMIN_IDS
+
+async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("Команда доступна только администраторам.")
+        return
+    stats_lines = []
     
-    # Проверяем переменные окружения
-    debug_info.append(f"YANDEX_FOLDER_ID: {'✅ настроен' if folder_id else '❌ не настроен'}")
-    debug_info.append(f"NEUROAPI_API_KEY: {'✅ настроен' if NEUROAPI_API_KEY else '❌ не настроен'}")
+    # Конфигурация (без запроса токена: /stats не должен ждать yc CLI)
+    stats_lines.append(f"YANDEX_FOLDER_ID: {'✅ настроен' if folder_id else '❌ не настроен'}")
+    stats_lines.append(f"NEUROAPI_API_KEY: {'✅ настроен' if NEUROAPI_API_KEY else '❌ не настроен'}")
+    if iam_token:
+        stats_lines.append(f"IAM токен: ✅ получен (длина: {len(iam_token)})")
+    else:
+        stats_lines.append("IAM токен: ❌ не получен")
     
-    # Проверяем IAM токен
-    if not iam_token:
-        iam_token = fetch_iam_token()
+    # Латентность этапов пайплайна
+    stats_lines.append("")
+    stats_lines.append("Этап: p50 / p95 / p99, всего (ошибок), сейчас")
+    for stage, st in metrics.stage_summary().items():
+        stats_lines.append(
+            f"{stage}: {st['p50']:.2f} / {st['p95']:.2f} / {st['p99']:.2f}с, "
+            f"{st['count']} ({st['errors']}), {st['in_flight']}"
+        )
+    stats_lines.append("")
     
-    if iam_token:
-        debug_info.append(f"IAM токен: ✅ получен (длина: {len(iam_token)})")
+    # Расходы
+    usage = metering.snapshot()
+    stats_lines.append(
+        f"Расходы сегодня: {usage['cost_today']:.2f} на {usage['users_today']} польз. "
+        f"(максимум у одного {usage['top_user_cost']:.2f}), токенов {usage['tokens_in_today']}/{usage['tokens_out_today']}, "
+        f"картинок {usage['images_today']}, символов TTS {usage['tts_chars_today']}"
+    )
+    stats_lines.append(
+        f"Сказка в среднем: {usage['avg_story_cost']:.2f} за {usage['avg_story_seconds']:.0f}с"
+    )
+    
+    # Состояние предохранителей бэкендов
+    for name, breaker in BREAKERS.items():
+        snap = breaker.snapshot()
+        stats_lines.append(f"Предохранитель {name}: {snap['state']} (ошибок подряд: {snap['failures']})")
+    
+    # Объединение одинаковых запросов
+    for flights in (art_flights, tts_flights):
+        snap = flights.snapshot()
+        stats_lines.append(
+            f"Single-flight {flights.name}: в полёте {snap['in_flight']}, запусков {snap['started']}, "
+            f"присоединений {snap['coalesced']}"
+        )
+    
+    # Доставка сказок: вызовы Bot API и время по режимам
+    for mode, d in delivery_snapshot().items():
+        stats_lines.append(f"Доставка {mode}: {d['stories']} сказок, в среднем {d['avg_calls']:.1f} вызовов Bot API, {d['avg_seconds']:.0f}с")
+    
+    # Перекодирование картинок
+    img = imaging.snapshot()
+    if img['enabled']:
+        stats_lines.append(
+            f"Картинки: {img['format']} q{img['quality']}, {img['images']} шт., "
+            f"сэкономлено {img['bytes_saved'] / 1e6:.1f} МБ (в среднем {img['avg_saved'] / 1e3:.0f} КБ, "
+            f"размер {img['ratio'] * 100:.0f}% от исходного)"
+        )
     else:
-        debug_info.append("IAM токен: ❌ не получен")
+        stats_lines.append("Картинки: отправляются без перекодирования")
+    
+    # Спул медиафайлов
+    sp = media_spool.snapshot()
+    stats_lines.append(
+        f"Спул медиа: {sp['files']} файлов, {sp['bytes'] / 1e6:.1f}/{sp['max_bytes'] / 1e6:.0f} МБ, "
+        f"записано {sp['written']}, общих {sp['shared']}, вытеснено {sp['evicted']}, "
+        f"утечек {sp['leaked']}, посторонних {sp['orphans']}"
+    )
+    
+    # Фоновые задачи и очереди Art/TTS
+    sched = scheduler.snapshot()
+    tiers = ", ".join(
+        f"{name} {t['active']}/{t['limit']} (в очереди {t['waiting']} от {t['users']} польз.)"
+        for name, t in sched['tiers'].items()
+    )
+    stats_lines.append(f"Фоновые задачи: {sched['jobs']}; {tiers}")
+    
+    # Режим качества иллюстраций
+    quality = quality_controller.snapshot()
+    stats_lines.append(
+        f"Качество: {quality['mode']}, таймаут картинки {quality['art_timeout']:.0f}с, "
+        f"в SLO {quality['within_slo']}/{quality['stories']} сказок"
+    )
     
-    # Проверяем конфигурацию для Art API
-    if folder_id and iam_token:
-        debug_info.append(f"Model URI: art://{folder_id}/yandex-art/latest")
-        debug_info.append(f"Art API URL: {YANDEX_ART_URL}")
+    # Статистика маршрутизации LLM
+    routing = llm_router.export_stats()
+    for model, lat in routing['latency'].items():
+        stats_lines.append(f"LLM {model}: {lat['count']} ответов, p50 {lat['p50']:.1f}с, p90 {lat['p90']:.1f}с")
+    for route, r in routing['routes'].items():
+        stats_lines.append(f"Маршрут {route}: {r['requests']} запросов, хеджей {r['hedged']}, победы {r['wins']}, ошибок {r['errors']}")
     
-    await update.message.reply_text("\n".join(debug_info))
+    await update.message.reply_text("\n".join(stats_lines))
 
 # --- Тестовая команда для отладки TTS ---
 async def test_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -845,26 +1232,32 @@ async def test_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Готовлю тестовое аудио...")
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.RECORD_VOICE)
     try:
-        ogg_path, mp3_path = await synthesize_tts(test_text, folder_id)
-        with open(ogg_path, 'rb') as voice:
-            await context.bot.send_voice(chat_id=update.effective_chat.id, voice=voice)
-        if mp3_path and os.path.exists(mp3_path):
-            with open(mp3_path, 'rb') as audio:
-                await context.bot.send_audio(chat_id=update.effective_chat.id, audio=audio, filename='test.mp3')
+        ogg, mp3 = await synthesize_tts(test_text, folder_id, mp3=True)
+        try:
+            with ogg.open() as voice:
+                await context.bot.send_voice(chat_id=update.effective_chat.id, voice=voice)
+            if mp3:
+                with mp3.open() as audio:
+                    await context.bot.send_audio(chat_id=update.effective_chat.id, audio=audio, filename='test.mp3')
+        finally:
+            ogg.release()
+            if mp3:
+                mp3.release()
     except Exception as e:
         if str(e) == 'TTS_TEXT_TOO_LONG':
             await update.message.reply_text("Эта сказка слишком длинная. Я не смогу ее прочитать.")
+        elif isinstance(e, CircuitOpenError):
+            await update.message.reply_text("Озвучка временно недоступна. Попробуйте через пару минут.")
         else:
-            await update.message.reply_text(f"Ошибка синтеза: {e}")
+            logging.error(f"Ошибка тестового синтеза: {e}")
+            await update.message.reply_text("Ошибка синтеза, подробности в логах.")
 
-async def synthesize_tts(text, folder_id):
-    global iam_token
-    # Получаем актуальный IAM токен
-    if not iam_token:
-        iam_token = fetch_iam_token()
-        if not iam_token:
-            raise Exception('Не удалось получить IAM токен')
-    url = 'https://tts.api.cloud.yandex.net/speech/v1/tts:synthesize'
+async def synthesize_tts(text, folder_id, mp3=False):
+    """Синтез речи: ссылки на файлы спула (ogg, mp3 или None). mp3 конвертируется только по запросу"""
+    import aiohttp
+    # Получаем актуальный IAM токен (при запуске он может ещё получаться в фоне)
+    if not await get_iam_token():
+        raise CircuitOpenError('iam')
     headers = {
         'Authorization': 'Bearer ' + iam_token,
     }
@@ -877,32 +1270,82 @@ async def synthesize_tts(text, folder_id):
         'format': 'oggopus',
         'sampleRateHertz': 48000
     }
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, data=data) as resp:
-            if resp.status != 200:
-                err_text = await resp.text()
-                if 'Requested text length exceed limitation' in err_text:
-                    raise Exception('TTS_TEXT_TOO_LONG')
-                raise Exception(f"TTS error: {err_text}")
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.ogg') as f:
+    
+    async def request_tts():
+        async with aiohttp.ClientSession() as session:
+            async with session.post(YANDEX_TTS_URL, headers=headers, data=data) as resp:
+                if resp.status != 200:
+                    err_text = await resp.text()
+                    if 'Requested text length exceed limitation' in err_text:
+                        raise BackendError('TTS_TEXT_TOO_LONG', resp.status)
+                    raise BackendError(f"TTS error: {err_text}", resp.status)
                 content = await resp.read()
                 if not content:
                     raise Exception("TTS API вернул пустой аудиофайл. Попробуйте другой текст или повторите попытку позже.")
-                f.write(content)
-                ogg_path = f.name
-    # Конвертация oggopus -> mp3 через ffmpeg
-    mp3_path = ogg_path.replace('.ogg', '.mp3')
+                metering.record_tts(len(text))
+                return content
+    
+    # Одинаковый текст с теми же параметрами синтезируется один раз на всех ожидающих,
+    # а начисляется каждому из них
+    tts_key = normalize_key('tts', text, data['voice'], data['emotion'], data['format'])
+    with metrics.span('tts'), metering.shared_scope():
+        content = await tts_flights.do(tts_key, scheduler.run_background, 'tts', call_backend, 'tts', request_tts)
+    metering.charge_tts(len(text))
+    # Ожидающие одного синтеза делят файл ogg
+    ogg = await media_spool.write(content, '.ogg', key=tts_key)
+    if not mp3:
+        return ogg, None
+    # Конвертация oggopus -> mp3 через ffmpeg (асинхронный процесс, цикл событий не ждёт)
+    mp3_file = media_spool.reserve('.mp3')
     try:
-        result = subprocess.run([
-            'ffmpeg', '-y', '-i', ogg_path, '-acodec', 'libmp3lame', mp3_path
-        ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if result.returncode != 0 or not os.path.exists(mp3_path):
-            logging.error(f"ffmpeg error: {result.stderr.decode('utf-8')}")
-            mp3_path = None
+        with metrics.span('tts_convert'):
+            proc = await asyncio.create_subprocess_exec(
+                'ffmpeg', '-y', '-i', ogg.path, '-acodec', 'libmp3lame', mp3_file.path,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            )
+            try:
+                _, stderr = await proc.communicate()
+            except BaseException:
+                # Задачу отменили (остановка бота): ffmpeg не должен её пережить
+                if proc.returncode is None:
+                    proc.kill()
+                await proc.wait()
+                raise
+        if proc.returncode != 0 or not os.path.exists(mp3_file.path):
+            logging.error(f"ffmpeg error: {stderr.decode('utf-8')}")
+            mp3_file.release()
+            mp3_file = None
+    except asyncio.CancelledError:
+        mp3_file.release()
+        ogg.release()
+        raise
     except Exception as e:
         logging.error(f"ffmpeg exception: {e}")
-        mp3_path = None
-    return ogg_path, mp3_path
+        mp3_file.release()
+        mp3_file = None
+    if mp3_file:
+        media_spool.commit(mp3_file)
+    return ogg, mp3_file
+
+async def send_story_audio(update, context, story, state):
+    """Синтез и отправка аудио сказки (длинная — двумя частями). Возвращает file_id голосовых"""
+    texts = [story]
+    if state and state.get('length') == 'long':
+        mid = len(story) // 2
+        split_idx = story.rfind('.', 0, mid)
+        if split_idx == -1:
+            split_idx = story.rfind(' ', 0, mid)
+        if split_idx == -1:
+            split_idx = mid
+        texts = [story[:split_idx+1].strip(), story[split_idx+1:].strip()]
+    file_ids = []
+    for text in texts:
+        ogg, _ = await synthesize_tts(text, folder_id)
+        with ogg, ogg.open() as voice, metrics.span('upload'):
+            message = await context.bot.send_voice(chat_id=update.effective_chat.id, voice=voice)
+        if message.voice:
+            file_ids.append(message.voice.file_id)
+    return file_ids
 
 # --- Команда /audio ---
 async def audio_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -912,31 +1355,30 @@ async def audio_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not story:
         await update.message.reply_text("Сначала сгенерируйте сказку командой /start или /new.")
         return
+    # Сказка из библиотеки уже озвучивалась — отправляем сохранённые голосовые по file_id
+    story_id = state.get('story_id') if state else None
+    entry = await story_library.get(user_id, story_id) if story_id else None
+    if entry and entry['voice']:
+        for file_id in entry['voice']:
+            await context.bot.send_voice(chat_id=update.effective_chat.id, voice=file_id)
+        metrics.inc('library_voice_replays')
+        return
     await update.message.reply_text("Готовлю аудиофайл...")
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.RECORD_VOICE)
     try:
-        if state and state.get('length') == 'long':
-            mid = len(story) // 2
-            split_idx = story.rfind('.', 0, mid)
-            if split_idx == -1:
-                split_idx = story.rfind(' ', 0, mid)
-            if split_idx == -1:
-                split_idx = mid
-            part1 = story[:split_idx+1].strip()
-            part2 = story[split_idx+1:].strip()
-            ogg_path1, _ = await synthesize_tts(part1, folder_id)
-            with open(ogg_path1, 'rb') as voice1:
-                await context.bot.send_voice(chat_id=update.effective_chat.id, voice=voice1)
-            ogg_path2, _ = await synthesize_tts(part2, folder_id)
-            with open(ogg_path2, 'rb') as voice2:
-                await context.bot.send_voice(chat_id=update.effective_chat.id, voice=voice2)
-        else:
-            ogg_path, _ = await synthesize_tts(story, folder_id)
-            with open(ogg_path, 'rb') as voice:
-                await context.bot.send_voice(chat_id=update.effective_chat.id, voice=voice)
+        with metrics.span('audio_total'), metering.user_scope(user_id):
+            file_ids = await send_story_audio(update, context, story, state)
+        if story_id and file_ids:
+            await story_library.set_voice(user_id, story_id, file_ids)
+    except asyncio.CancelledError:
+        if scheduler.is_draining():
+            await update.message.reply_text(RESTARTING_TEXT + " Озвучку можно будет запросить снова: /audio")
+        raise
     except Exception as e:
         if str(e) == 'TTS_TEXT_TOO_LONG':
             await update.message.reply_text("Эта сказка слишком длинная. Я не смогу ее прочитать.")
+        elif isinstance(e, CircuitOpenError):
+            await update.message.reply_text("Озвучка временно недоступна. Попробуйте через пару минут.")
         else:
             await update.message.reply_text(f"Не удалось синтезировать аудио, простите. Попробуйте позже.")
             logging.error(f"Ошибка синтеза аудио: {e}")
@@ -964,20 +1406,76 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 # --- Main ---
-def main():
-    # Запускаем обновление IAM токена
-    schedule_iam_token_update()
-    token = os.getenv('TELEGRAM_BOT_TOKEN')
-    app = ApplicationBuilder().token(token).build()
+async def on_startup(app):
+    # IAM токен получаем в фоне: апдейты принимаются сразу, Art и TTS ждут токен сами
+    if not iam_token:
+        start_iam_token_refresh()
+    # Каталог спула медиа и удаление файлов, оставшихся от прошлого запуска
+    await media_spool.start()
+    # Расходы пользователей за сегодня из прошлого запуска и их фоновое сохранение
+    await usage_store.load()
+    app.bot_data['usage_task'] = asyncio.create_task(usage_store.run())
+    # Эндпоинт /metrics для Prometheus (если задан METRICS_PORT)
+    app.bot_data['metrics_runner'] = await metrics.start_metrics_server()
+
+async def on_stop(app):
+    # Апдейты больше не принимаются: даём сказкам и озвучке закончиться, остальные прерываем с сохранением
+    await scheduler.drain()
+
+async def on_shutdown(app):
+    if _iam_token_task is not None:
+        _iam_token_task.cancel()
+        try:
+            await _iam_token_task
+        except asyncio.CancelledError:
+            pass
+    await llm_router.close()
+    runner = app.bot_data.get('metrics_runner')
+    if runner is not None:
+        await runner.cleanup()
+    story_library.close()
+    usage_task = app.bot_data.get('usage_task')
+    if usage_task is not None:
+        usage_task.cancel()
+        try:
+            await usage_task
+        except asyncio.CancelledError:
+            pass
+    # После drain все сказки уже учтены: сохраняем итоги целиком
+    await usage_store.flush()
+    usage_store.close()
+    imaging.close()
+    media_spool.clear()
+    scheduler.close()
+    logging.info("Бот остановлен")
+
+def build_application(token, base_url=None):
+    # telegram.ext импортируем здесь: модуль бота быстро импортируется скриптами и бенчмарками
+    from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler, MessageHandler, filters
+    builder = (
+        ApplicationBuilder().token(token).post_init(on_startup).post_stop(on_stop).post_shutdown(on_shutdown)
+        # Апдейты разных пользователей обрабатываются параллельно, одного — по порядку
+        .concurrent_updates(scheduler.interactive_processor())
+    )
+    base_url = base_url or TELEGRAM_API_URL
+    if base_url:
+        builder = builder.base_url(base_url)
+    app = builder.build()
     app.add_handler(CommandHandler('start', start))
     app.add_handler(CommandHandler('help', help_cmd))
     app.add_handler(CommandHandler('new', new_cmd))
-    app.add_handler(CommandHandler('audio', audio_cmd))
-    app.add_handler(CommandHandler('test', test_cmd))
-    app.add_handler(CommandHandler('testimg', test_image_cmd))
-    app.add_handler(CommandHandler('debug', debug_cmd))
+    # Команды с синтезом и генерацией выполняются фоновыми задачами, как и сама сказка
+    app.add_handler(CommandHandler('audio', scheduler.background(audio_cmd, 'audio', reply_restarting)))
+    app.add_handler(CommandHandler('library', library_cmd))
+    app.add_handler(CommandHandler('test', scheduler.background(test_cmd, 'test', reply_restarting)))
+    app.add_handler(CommandHandler('testimg', scheduler.background(test_image_cmd, 'testimg', reply_restarting)))
+    app.add_handler(CommandHandler('stats', stats_cmd))
     app.add_handler(CallbackQueryHandler(button))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler))
+    return app
+
+def main():
+    app = build_application(os.getenv('TELEGRAM_BOT_TOKEN'))
     app.run_polling()
 
 if __name__ == '__main__':
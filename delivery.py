@@ -0,0 +1,184 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+
+from telegram import InputMediaPhoto
+
+import metrics
+
+# --- Конфиг доставки ---
+# 'parts' — текст и картинка каждой части отдельными сообщениями,
+# 'album' — картинки с текстом в подписи, сгруппированные в альбомы send_media_group
+STORY_DELIVERY_MODE = os.getenv('STORY_DELIVERY_MODE', 'parts')
+
+# Ограничения Bot API
+CAPTION_LIMIT = 1024
+MEDIA_GROUP_LIMIT = 10
+# Статус "печатает/загружает фото" держится ~5 секунд, чаще обновлять бессмысленно
+CHAT_ACTION_TTL = 4.5
+
+# Замеры доставки по режимам: (вызовов Bot API, секунд)
+DELIVERY_STATS = {}
+
+
+class StoryDelivery:
+    """Обёртка над context.bot для одного чата: считает вызовы Bot API и не дублирует chat action"""
+    def __init__(self, bot, chat_id, mode=None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.mode = mode or STORY_DELIVERY_MODE
+        self.calls = 0
+        self.started = time.monotonic()
+        # Отправленное в чат: ('text', текст), ('photo', file_id, подпись), ('album', [(file_id, подпись)])
+        # — по этим шагам сказка повторяется из библиотеки без генерации и загрузки файлов
+        self.steps = []
+        self._last_action = None
+        self._last_action_at = 0.0
+
+    async def chat_action(self, action):
+        """Показать статус, если такой же не был отправлен в последние CHAT_ACTION_TTL секунд"""
+        now = time.monotonic()
+        if action == self._last_action and now - self._last_action_at < CHAT_ACTION_TTL:
+            return
+        self._last_action, self._last_action_at = action, now
+        self.calls += 1
+        await self.bot.send_chat_action(chat_id=self.chat_id, action=action)
+
+    async def wait(self, awaitable, action):
+        """Дождаться результата, обновляя статус action, чтобы чат не выглядел замершим"""
+        task = asyncio.ensure_future(awaitable)
+        try:
+            while True:
+                done, _ = await asyncio.wait({task}, timeout=CHAT_ACTION_TTL)
+                if done:
+                    return task.result()
+                try:
+                    await self.chat_action(action)
+                except Exception as e:
+                    logging.warning(f"Не удалось обновить статус чата {self.chat_id}: {e}")
+        finally:
+            if not task.done():
+                task.cancel()
+
+    def _sent(self):
+        # Любое сообщение сбрасывает статус в клиенте Telegram
+        self.calls += 1
+        self._last_action = None
+
+    async def send_message(self, text):
+        self._sent()
+        with metrics.span('upload'):
+            message = await self.bot.send_message(chat_id=self.chat_id, text=text)
+        self.steps.append(('text', text))
+        return message
+
+    async def send_photo(self, photo, caption=None):
+        self._sent()
+        with metrics.span('upload'), metrics.span('upload_photo'):
+            message = await self.bot.send_photo(chat_id=self.chat_id, photo=photo, caption=caption)
+        file_id = photo_file_id(message)
+        if file_id:
+            self.steps.append(('photo', file_id, caption))
+        return message
+
+    async def send_album(self, items):
+        """Отправить список (photo, caption): альбомами по 10, одиночное фото — через send_photo"""
+        messages = []
+        for start in range(0, len(items), MEDIA_GROUP_LIMIT):
+            chunk = items[start:start + MEDIA_GROUP_LIMIT]
+            if len(chunk) == 1:
+                messages.append(await self.send_photo(chunk[0][0], chunk[0][1]))
+                continue
+            self._sent()
+            media = [InputMediaPhoto(media=photo, caption=caption) for photo, caption in chunk]
+            with metrics.span('upload'), metrics.span('upload_photo'):
+                sent = await self.bot.send_media_group(chat_id=self.chat_id, media=media)
+            messages.extend(sent)
+            recorded = [(photo_file_id(m), caption) for m, (_, caption) in zip(sent, chunk)]
+            self.steps.append(('album', [(f, c) for f, c in recorded if f]))
+        return messages
+
+    async def replay(self, steps):
+        """Повторить сохранённые шаги: фото уходят по file_id, без повторной загрузки"""
+        for step in steps:
+            kind = step[0]
+            if kind == 'text':
+                await self.send_message(step[1])
+            elif kind == 'photo':
+                await self.send_photo(step[1], step[2])
+            elif kind == 'album' and step[1]:
+                await self.send_album([tuple(item) for item in step[1]])
+
+    def sent_texts(self):
+        """Тексты сообщений и подписи, уже отправленные в чат"""
+        texts = set()
+        for step in self.steps:
+            if step[0] == 'text':
+                texts.add(step[1])
+            elif step[0] == 'photo':
+                texts.add(step[2])
+            elif step[0] == 'album':
+                texts.update(caption for _, caption in step[1])
+        return texts
+
+    def finish(self):
+        """Зафиксировать замер доставки сказки"""
+        seconds = time.monotonic() - self.started
+        DELIVERY_STATS.setdefault(self.mode, deque(maxlen=200)).append((self.calls, seconds))
+        logging.info(f"Доставка ({self.mode}): {self.calls} вызовов Bot API за {seconds:.1f}с")
+        return self.calls, seconds
+
+
+def photo_file_id(message):
+    """file_id самого большого размера отправленного фото (None, если фото нет)"""
+    photo = getattr(message, 'photo', None)
+    return photo[-1].file_id if photo else None
+
+
+def plan_album(parts, images, last_caption="🎨 Конец сказки", start=0, total=None):
+    """Разложить части сказки на шаги доставки с сохранением порядка.
+
+    parts — тексты частей, images — фото (bytes) или None для каждой части.
+    Возвращает список шагов ('album', [(photo, caption), ...]) и ('text', text):
+    части с картинкой и коротким текстом идут в подпись, длинный текст
+    отправляется сообщением перед своей картинкой. Для фрагмента сказки start —
+    номер его первой части, total — число частей во всей сказке.
+    """
+    total = len(parts) + start if total is None else total
+    steps = []
+    album = []
+
+    def flush():
+        if album:
+            steps.append(('album', list(album)))
+            album.clear()
+
+    for i, (part, photo) in enumerate(zip(parts, images)):
+        if photo is None:
+            flush()
+            steps.append(('text', part))
+        elif len(part) <= CAPTION_LIMIT:
+            album.append((photo, part))
+        else:
+            flush()
+            steps.append(('text', part))
+            index = start + i
+            caption = last_caption if index == total - 1 else f"🎨 Часть {index + 2}"
+            album.append((photo, caption))
+    flush()
+    return steps
+
+
+def delivery_snapshot():
+    """Среднее число вызовов Bot API и время доставки по режимам"""
+    result = {}
+    for mode, samples in DELIVERY_STATS.items():
+        if samples:
+            result[mode] = {
+                'stories': len(samples),
+                'avg_calls': sum(c for c, _ in samples) / len(samples),
+                'avg_seconds': sum(t for _, t in samples) / len(samples),
+            }
+    return result
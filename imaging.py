@@ -0,0 +1,122 @@
+import io
+import os
+import base64
+import asyncio
+import logging
+import importlib.util
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import metrics
+
+# --- Конфиг перекодирования картинок ---
+# Перекодировать картинки Art перед отправкой, 0 — отправлять PNG как есть
+IMAGE_TRANSCODE = os.getenv('IMAGE_TRANSCODE', '1') != '0'
+# JPEG или WEBP
+IMAGE_FORMAT = os.getenv('IMAGE_FORMAT', 'JPEG').upper()
+IMAGE_QUALITY = int(os.getenv('IMAGE_QUALITY', '85'))
+# Telegram сжимает фото до 1280 px по длинной стороне, больше отправлять незачем
+IMAGE_MAX_SIDE = int(os.getenv('IMAGE_MAX_SIDE', '1280'))
+# Процессов для перекодирования: в потоках сжатие отнимало бы GIL у цикла событий и кнопки ждали бы
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', '2'))
+# Приоритет процессов перекодирования (nice): на занятом CPU цикл событий бота важнее сжатия
+IMAGE_NICE = int(os.getenv('IMAGE_NICE', '10'))
+
+SUFFIXES = {'JPEG': '.jpg', 'WEBP': '.webp'}
+# Pillow необязателен: без него картинки отправляются без изменений
+HAS_PILLOW = importlib.util.find_spec('PIL') is not None
+
+IMAGE_STATS = {'images': 0, 'skipped': 0, 'bytes_in': 0, 'bytes_out': 0}
+
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        # spawn, а не fork: бот многопоточный, форк с чужими блокировками может зависнуть
+        _executor = ProcessPoolExecutor(
+            max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context('spawn'),
+            initializer=os.nice, initargs=(IMAGE_NICE,),
+        )
+    return _executor
+
+
+def decode(data):
+    """bytes как есть, строку base64 — в bytes"""
+    return base64.b64decode(data) if isinstance(data, str) else data
+
+
+def transcode(data, suffix):
+    """В процессе-воркере: декодировать base64, уменьшить до IMAGE_MAX_SIDE и сжать в IMAGE_FORMAT.
+    Возвращает (bytes, суффикс файла, исходный размер); если сжатие не помогло — исходные байты"""
+    from PIL import Image
+    data = decode(data)
+    with Image.open(io.BytesIO(data)) as image:
+        image.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        options = {'quality': IMAGE_QUALITY}
+        if IMAGE_FORMAT == 'JPEG':
+            options.update(optimize=True, progressive=True)
+        out = io.BytesIO()
+        image.save(out, IMAGE_FORMAT, **options)
+    result = out.getvalue()
+    if len(result) >= len(data):
+        return data, suffix, len(data)
+    return result, SUFFIXES.get(IMAGE_FORMAT, '.jpg'), len(data)
+
+
+def enabled():
+    return IMAGE_TRANSCODE and HAS_PILLOW
+
+
+async def optimize(data, suffix='.png'):
+    """Картинка (bytes или base64) -> (bytes, суффикс), пережатая в пуле процессов.
+
+    Декодирование base64 тоже идёт в воркере: мегабайты в основном процессе держали бы GIL.
+    При ошибке, без Pillow или если результат не меньше исходника — исходные байты и суффикс.
+    """
+    loop = asyncio.get_running_loop()
+    if not enabled():
+        return await loop.run_in_executor(None, decode, data), suffix
+    try:
+        with metrics.span('image_transcode'):
+            result, new_suffix, size = await loop.run_in_executor(_get_executor(), transcode, data, suffix)
+    except Exception as e:
+        logging.warning(f"Не удалось перекодировать картинку: {e}")
+        IMAGE_STATS['skipped'] += 1
+        return await loop.run_in_executor(None, decode, data), suffix
+    if len(result) >= size:
+        IMAGE_STATS['skipped'] += 1
+        return result, suffix
+    IMAGE_STATS['images'] += 1
+    IMAGE_STATS['bytes_in'] += size
+    IMAGE_STATS['bytes_out'] += len(result)
+    metrics.inc('image_bytes_saved', size - len(result))
+    logging.info(f"Картинка перекодирована в {IMAGE_FORMAT}: {size} -> {len(result)} байт "
+                 f"(-{(1 - len(result) / size) * 100:.0f}%)")
+    return result, new_suffix
+
+
+def close():
+    """Остановить процессы перекодирования (при остановке бота)"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+
+
+def snapshot():
+    images = IMAGE_STATS['images']
+    saved = IMAGE_STATS['bytes_in'] - IMAGE_STATS['bytes_out']
+    return {
+        'enabled': enabled(),
+        'format': IMAGE_FORMAT,
+        'quality': IMAGE_QUALITY,
+        'images': images,
+        'skipped': IMAGE_STATS['skipped'],
+        'bytes_saved': saved,
+        'avg_saved': saved / images if images else 0,
+        'ratio': IMAGE_STATS['bytes_out'] / IMAGE_STATS['bytes_in'] if IMAGE_STATS['bytes_in'] else 1.0,
+    }
@@ -0,0 +1,128 @@
+import os
+import json
+import time
+import zlib
+import asyncio
+import sqlite3
+import logging
+import threading
+
+# --- Конфиг библиотеки сказок ---
+# Файл SQLite с прошлыми сказками пользователей
+LIBRARY_PATH = os.getenv('LIBRARY_PATH', 'data/library.sqlite3')
+# Сколько последних сказок хранить на пользователя
+LIBRARY_MAX_STORIES = int(os.getenv('LIBRARY_MAX_STORIES', '20'))
+# Сколько сказок показывать в /library
+LIBRARY_PAGE = 10
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stories (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    title TEXT NOT NULL,
+    payload BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS stories_user ON stories (user_id, id);
+"""
+
+
+def pack(data):
+    return zlib.compress(json.dumps(data, ensure_ascii=False).encode('utf-8'), 9)
+
+
+def unpack(blob):
+    return json.loads(zlib.decompress(blob).decode('utf-8'))
+
+
+class StoryLibrary:
+    """Прошлые сказки пользователей: сжатый текст, промпты иллюстраций и file_id отправленных медиа.
+
+    Шаги доставки хранятся с file_id Telegram, поэтому повтор сказки не обращается
+    ни к LLM, ни к Art, ни к TTS и не загружает файлы заново. Запросы к SQLite
+    выполняются в потоке, чтобы не блокировать цикл событий.
+    """
+    def __init__(self, path=LIBRARY_PATH, max_stories=LIBRARY_MAX_STORIES):
+        self.path = path
+        self.max_stories = max_stories
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    def _save(self, user_id, title, payload):
+        with self._lock:
+            db = self._connect()
+            cursor = db.execute(
+                'INSERT INTO stories (user_id, created_at, title, payload) VALUES (?, ?, ?, ?)',
+                (user_id, time.time(), title, pack(payload)),
+            )
+            db.execute(
+                'DELETE FROM stories WHERE user_id = ? AND id NOT IN '
+                '(SELECT id FROM stories WHERE user_id = ? ORDER BY id DESC LIMIT ?)',
+                (user_id, user_id, self.max_stories),
+            )
+            db.commit()
+            return cursor.lastrowid
+
+    def _recent(self, user_id, limit):
+        with self._lock:
+            rows = self._connect().execute(
+                'SELECT id, created_at, title FROM stories WHERE user_id = ? ORDER BY id DESC LIMIT ?',
+                (user_id, limit),
+            ).fetchall()
+        return [{'id': i, 'created_at': created_at, 'title': title} for i, created_at, title in rows]
+
+    def _get(self, user_id, story_id):
+        with self._lock:
+            row = self._connect().execute(
+                'SELECT created_at, title, payload FROM stories WHERE id = ? AND user_id = ?',
+                (story_id, user_id),
+            ).fetchone()
+        if row is None:
+            return None
+        created_at, title, payload = row
+        return dict(unpack(payload), id=story_id, created_at=created_at, title=title)
+
+    def _update(self, user_id, story_id, **changes):
+        with self._lock:
+            db = self._connect()
+            row = db.execute(
+                'SELECT payload FROM stories WHERE id = ? AND user_id = ?', (story_id, user_id)
+            ).fetchone()
+            if row is None:
+                return False
+            payload = dict(unpack(row[0]), **changes)
+            db.execute('UPDATE stories SET payload = ? WHERE id = ?', (pack(payload), story_id))
+            db.commit()
+            return True
+
+    async def save(self, user_id, title, story, params, prompts, steps):
+        """Сохранить доставленную сказку, вернуть её id"""
+        payload = {'text': story, 'params': params, 'prompts': prompts, 'steps': steps, 'voice': []}
+        story_id = await asyncio.to_thread(self._save, user_id, title, payload)
+        logging.info(f"Сказка {story_id} пользователя {user_id} сохранена в библиотеку")
+        return story_id
+
+    async def recent(self, user_id, limit=LIBRARY_PAGE):
+        return await asyncio.to_thread(self._recent, user_id, limit)
+
+    async def get(self, user_id, story_id):
+        return await asyncio.to_thread(self._get, user_id, story_id)
+
+    async def set_voice(self, user_id, story_id, file_ids):
+        """Запомнить file_id озвучки, чтобы повторный /audio обходился без TTS"""
+        return await asyncio.to_thread(self._update, user_id, story_id, voice=file_ids)
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,213 @@
+import os
+import time
+import json
+import asyncio
+import logging
+from collections import deque
+
+import metering
+from resilience import BackendError, call_backend, get_breaker
+
+# --- Конфиг маршрутизации ---
+# Перцентиль латентности основной модели, после которого отправляется хедж-запрос
+HEDGE_PERCENTILE = float(os.getenv('LLM_HEDGE_PERCENTILE', '0.9'))
+# Минимум замеров, прежде чем доверять перцентилю
+HEDGE_MIN_SAMPLES = int(os.getenv('LLM_HEDGE_MIN_SAMPLES', '5'))
+# Нижняя граница задержки хеджа, секунды: быстрые окна не превращают каждый запрос в два платных
+HEDGE_MIN_DELAY = float(os.getenv('LLM_HEDGE_MIN_DELAY', '1'))
+# Размер окна замеров на модель
+LATENCY_WINDOW = int(os.getenv('LLM_LATENCY_WINDOW', '200'))
+# Файл для выгрузки решений маршрутизатора (JSONL), пусто — не писать
+ROUTING_LOG_PATH = os.getenv('LLM_ROUTING_LOG', '')
+
+# Маршруты: основная модель, быстрая запасная, задержка хеджа до накопления статистики, таймаут
+ROUTES = {
+    'story': {
+        'primary': os.getenv('STORY_MODEL', 'gemini-2.5-pro'),
+        'fallback': os.getenv('STORY_FALLBACK_MODEL', 'gemini-2.5-flash'),
+        'default_hedge_delay': float(os.getenv('STORY_HEDGE_DELAY', '60')),
+        'timeout': float(os.getenv('STORY_TIMEOUT', '300')),
+    },
+    'prompt': {
+        'primary': os.getenv('PROMPT_MODEL', 'gpt-4o-mini'),
+        'fallback': os.getenv('PROMPT_FALLBACK_MODEL', 'gemini-2.5-flash'),
+        'default_hedge_delay': float(os.getenv('PROMPT_HEDGE_DELAY', '8')),
+        'timeout': float(os.getenv('PROMPT_TIMEOUT', '60')),
+    },
+}
+
+
+class LLMError(BackendError):
+    """Ошибка ответа LLM бэкенда"""
+
+
+class LatencyTracker:
+    """Скользящее окно латентностей успешных ответов по каждой модели"""
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self.samples = {}
+
+    def record(self, model, seconds):
+        self.samples.setdefault(model, deque(maxlen=self.window)).append(seconds)
+
+    def count(self, model):
+        return len(self.samples.get(model, ()))
+
+    def percentile(self, model, p):
+        values = sorted(self.samples.get(model, ()))
+        if not values:
+            return None
+        idx = min(len(values) - 1, max(0, int(round(p * (len(values) - 1)))))
+        return values[idx]
+
+    def snapshot(self):
+        return {
+            model: {
+                'count': len(values),
+                'p50': self.percentile(model, 0.5),
+                'p90': self.percentile(model, 0.9),
+                'p99': self.percentile(model, 0.99),
+            }
+            for model, values in self.samples.items()
+        }
+
+
+class LLMRouter:
+    """Маршрутизатор запросов к NeuroAPI с хеджированием на быструю модель"""
+    def __init__(self, url, api_key, routes=None):
+        self.url = url
+        self.api_key = api_key
+        self.routes = routes or ROUTES
+        self.latency = LatencyTracker()
+        self.decisions = deque(maxlen=500)
+        self._session = None
+
+    async def _get_session(self):
+        # aiohttp импортируется при первом запросе, а не при запуске бота
+        import aiohttp
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession()
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def hedge_delay(self, route):
+        """Сколько ждать основную модель перед отправкой хедж-запроса"""
+        cfg = self.routes[route]
+        if self.latency.count(cfg['primary']) < HEDGE_MIN_SAMPLES:
+            return cfg['default_hedge_delay']
+        return max(HEDGE_MIN_DELAY, self.latency.percentile(cfg['primary'], HEDGE_PERCENTILE))
+
+    async def _call(self, model, payload, timeout):
+        """Запрос к модели через её предохранитель и с повторами на временных ошибках"""
+        return await call_backend(f"llm:{model}", self._request, model, payload, timeout)
+
+    async def _request(self, model, payload, timeout):
+        import aiohttp
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}"
+        }
+        data = dict(payload, model=model)
+        session = await self._get_session()
+        started = time.monotonic()
+        async with session.post(self.url, headers=headers, json=data,
+                                timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+            if resp.status != 200:
+                error_text = await resp.text()
+                raise LLMError(f"LLM error {model} (status {resp.status}): {error_text}", resp.status)
+            result = await resp.json()
+        if 'choices' not in result or len(result['choices']) == 0:
+            raise LLMError(f"Invalid LLM response structure from {model}")
+        self.latency.record(model, time.monotonic() - started)
+        metering.record_llm(model, result.get('usage'))
+        return result
+
+    async def complete(self, route, payload):
+        """Выполнить запрос по маршруту, вернуть JSON ответа победившей модели"""
+        cfg = self.routes[route]
+        primary, fallback = cfg['primary'], cfg.get('fallback')
+        delay = self.hedge_delay(route)
+        skipped = None
+        if fallback and fallback != primary and get_breaker(f"llm:{primary}").is_open:
+            # Основная модель недоступна — сразу идём в запасную, не дожидаясь хеджа
+            logging.info(f"Предохранитель LLM {primary} разомкнут, используем {fallback}")
+            skipped, primary, fallback = primary, fallback, None
+        started = time.monotonic()
+        decision = {
+            'ts': time.time(),
+            'route': route,
+            'primary': primary,
+            'fallback': fallback,
+            'hedge_delay': delay,
+            'hedged': False,
+            'skipped_open': skipped,
+        }
+
+        tasks = {asyncio.ensure_future(self._call(primary, payload, cfg['timeout'])): primary}
+        try:
+            can_hedge = bool(fallback) and fallback != primary
+            done, _ = await asyncio.wait(tasks, timeout=delay if can_hedge else None)
+            primary_failed = bool(done) and next(iter(done)).exception() is not None
+            if can_hedge and (not done or primary_failed):
+                if primary_failed:
+                    logging.info(f"LLM {primary} вернула ошибку, переключаемся на {fallback}")
+                else:
+                    logging.info(f"LLM {primary} не ответила за {delay:.1f}с, отправляем хедж-запрос в {fallback}")
+                decision['hedged'] = True
+                tasks[asyncio.ensure_future(self._call(fallback, payload, cfg['timeout']))] = fallback
+
+            result, winner, error = None, None, None
+            pending = set(tasks)
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if winner is None:
+                            result, winner = task.result(), tasks[task]
+                    else:
+                        error = task.exception()
+                        logging.warning(f"LLM {tasks[task]} завершилась ошибкой: {error}")
+        finally:
+            for task, model in tasks.items():
+                if not task.done():
+                    task.cancel()
+                    if model == primary and winner is not None:
+                        # Основная модель проиграла хедж: её время известно только снизу. Без этого замера
+                        # в окне остаются одни быстрые ответы, и задержка хеджа сползает вниз
+                        self.latency.record(primary, time.monotonic() - started)
+
+        decision['winner'] = winner
+        decision['latency'] = time.monotonic() - started
+        decision['error'] = None if winner else str(error)
+        self._record_decision(decision)
+        if winner is None:
+            raise error
+        result['_routed_model'] = winner
+        return result
+
+    def _record_decision(self, decision):
+        self.decisions.append(decision)
+        if not ROUTING_LOG_PATH:
+            return
+        try:
+            with open(ROUTING_LOG_PATH, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(decision, ensure_ascii=False) + '\n')
+        except Exception as e:
+            logging.warning(f"Не удалось записать решение маршрутизатора: {e}")
+
+    def export_stats(self):
+        """Сводка для подбора порогов: латентности моделей и доля хеджей/побед"""
+        summary = {}
+        for d in self.decisions:
+            s = summary.setdefault(d['route'], {'requests': 0, 'hedged': 0, 'wins': {}, 'errors': 0})
+            s['requests'] += 1
+            s['hedged'] += int(d['hedged'])
+            if d['winner']:
+                s['wins'][d['winner']] = s['wins'].get(d['winner'], 0) + 1
+            else:
+                s['errors'] += 1
+        return {'latency': self.latency.snapshot(), 'routes': summary}
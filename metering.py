@@ -0,0 +1,303 @@
+import os
+import json
+import asyncio
+import sqlite3
+import logging
+import datetime
+import threading
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import metrics
+
+# --- Конфиг учёта расходов ---
+# Цены в условных единицах (рубли): LLM — за 1000 токенов, Art — за картинку, TTS — за 1000 символов.
+# Переопределяются целиком или частично через PRICES_JSON='{"gpt-4o-mini": {"in": 0.02, "out": 0.08}}'
+PRICES = {
+    'gemini-2.5-pro': {'in': 0.125, 'out': 1.0},
+    'gemini-2.5-flash': {'in': 0.03, 'out': 0.25},
+    'gpt-4o-mini': {'in': 0.015, 'out': 0.06},
+    'art': 2.2,
+    'tts': 1.32,
+}
+PRICES.update(json.loads(os.getenv('PRICES_JSON', '{}')))
+# Цена 1000 токенов для моделей, которых нет в PRICES
+DEFAULT_LLM_PRICE = {'in': 0.1, 'out': 0.4}
+
+# Дневной бюджет на пользователя, 0 — без ограничений
+USER_DAILY_BUDGET = float(os.getenv('USER_DAILY_BUDGET', '0'))
+# Доля бюджета, после которой сказки становятся короче и с меньшим числом картинок
+BUDGET_SOFT_LIMIT = float(os.getenv('BUDGET_SOFT_LIMIT', '0.75'))
+# Сколько дней хранить дневные итоги
+METERING_KEEP_DAYS = int(os.getenv('METERING_KEEP_DAYS', '7'))
+# Файл SQLite с дневными итогами: бюджеты переживают перезапуск бота
+METERING_PATH = os.getenv('METERING_PATH', 'data/metering.sqlite3')
+# Как часто сохранять изменившиеся итоги, секунды (при остановке сохраняются сразу)
+METERING_FLUSH_SECONDS = float(os.getenv('METERING_FLUSH_SECONDS', '30'))
+
+LENGTH_ORDER = ['short', 'medium', 'long']
+# Длина для неизвестного значения (например, нажатие устаревшей кнопки другого шага)
+DEFAULT_LENGTH = 'medium'
+
+# Кто и в рамках какой сказки сейчас тратит: наследуется задачами asyncio
+_current_user = ContextVar('metering_user', default=None)
+_current_story = ContextVar('metering_story', default=None)
+# False внутри общей single-flight операции: расходы начисляет каждый ожидающий сам
+_attributed = ContextVar('metering_attributed', default=True)
+
+# (user_id, дата) -> итоги за день
+USAGE = {}
+USAGE_FIELDS = ('tokens_in', 'tokens_out', 'images', 'tts_chars', 'cost', 'stories')
+# Ключи USAGE, изменившиеся после последнего сохранения
+_dirty = set()
+# Последние сказки: (секунды доставки, стоимость)
+STORY_COSTS = deque(maxlen=200)
+
+
+def _today():
+    return datetime.date.today().isoformat()
+
+
+def _usage(user_id):
+    """Итоги пользователя за сегодня для изменения: ключ попадёт в следующее сохранение"""
+    key = (user_id, _today())
+    if key not in USAGE:
+        USAGE[key] = {'tokens_in': 0, 'tokens_out': 0, 'images': 0, 'tts_chars': 0, 'cost': 0.0, 'stories': 0}
+        _expire_old_days()
+    _dirty.add(key)
+    return USAGE[key]
+
+
+def _cutoff():
+    return (datetime.date.today() - datetime.timedelta(days=METERING_KEEP_DAYS)).isoformat()
+
+
+def _expire_old_days():
+    cutoff = _cutoff()
+    for key in [k for k in USAGE if k[1] < cutoff]:
+        del USAGE[key]
+        _dirty.discard(key)
+
+
+def _charge(cost, bill=True, **counts):
+    """Записать расход на текущего пользователя и сказку; bill — учесть в общем счёте бота"""
+    user_id = _current_user.get() if _attributed.get() else None
+    if user_id is not None:
+        usage = _usage(user_id)
+        usage['cost'] += cost
+        for name, value in counts.items():
+            usage[name] += value
+    story = _current_story.get() if _attributed.get() else None
+    if story is not None:
+        story['cost'] += cost
+    if bill:
+        metrics.inc('cost_total', cost)
+
+
+def record_llm(model, usage):
+    """Учесть поле usage из ответа chat/completions"""
+    if not usage:
+        return
+    tokens_in = usage.get('prompt_tokens', 0) or 0
+    tokens_out = usage.get('completion_tokens', 0) or 0
+    price = PRICES.get(model, DEFAULT_LLM_PRICE)
+    cost = tokens_in / 1000 * price['in'] + tokens_out / 1000 * price['out']
+    metrics.inc(f'llm_tokens_in:{model}', tokens_in)
+    metrics.inc(f'llm_tokens_out:{model}', tokens_out)
+    _charge(cost, tokens_in=tokens_in, tokens_out=tokens_out)
+
+
+def record_image(count=1):
+    metrics.inc('art_images', count)
+    _charge(PRICES['art'] * count, images=count)
+
+
+def record_tts(chars):
+    metrics.inc('tts_chars', chars)
+    _charge(PRICES['tts'] * chars / 1000, tts_chars=chars)
+
+
+def charge_image(count=1):
+    """Начислить пользователю картинку из общей операции (в счёт бота она уже попала)"""
+    _charge(PRICES['art'] * count, bill=False, images=count)
+
+
+def charge_tts(chars):
+    """Начислить пользователю озвучку из общей операции (в счёт бота она уже попала)"""
+    _charge(PRICES['tts'] * chars / 1000, bill=False, tts_chars=chars)
+
+
+@contextmanager
+def shared_scope():
+    """Общая single-flight операция: её расходы идут только в счёт бота.
+
+    Задача операции копирует контекст первого ожидающего, поэтому без этого блока
+    вся стоимость досталась бы ему, а присоединившиеся получили бы результат
+    бесплатно. Вместо этого каждый ожидающий после получения результата
+    начисляет себе charge_image/charge_tts.
+    """
+    token = _attributed.set(False)
+    try:
+        yield
+    finally:
+        _attributed.reset(token)
+
+
+def current_user():
+    return _current_user.get()
+
+
+@contextmanager
+def user_scope(user_id):
+    """Все расходы внутри блока (и порождённых задач) записываются на user_id"""
+    token = _current_user.set(user_id)
+    try:
+        yield
+    finally:
+        _current_user.reset(token)
+
+
+@contextmanager
+def story_scope(user_id):
+    """Расходы одной сказки: отдаёт словарь, в котором копится стоимость"""
+    story = {'cost': 0.0}
+    user_token = _current_user.set(user_id)
+    story_token = _current_story.set(story)
+    try:
+        yield story
+    finally:
+        _current_story.reset(story_token)
+        _current_user.reset(user_token)
+        _usage(user_id)['stories'] += 1
+
+
+def record_story(seconds, cost):
+    STORY_COSTS.append((seconds, cost))
+    logging.info(f"Сказка доставлена за {seconds:.1f}с, стоимость {cost:.2f}")
+
+
+def spent_today(user_id):
+    return USAGE.get((user_id, _today()), {}).get('cost', 0.0)
+
+
+def budget_plan(user_id, length):
+    """Ограничения для новой сказки по расходам пользователя за сегодня.
+
+    Возвращает (длина, максимальный режим иллюстраций или None).
+    """
+    if length not in LENGTH_ORDER:
+        length = DEFAULT_LENGTH
+    if not USER_DAILY_BUDGET:
+        return length, None
+    spent = spent_today(user_id) / USER_DAILY_BUDGET
+    if spent >= 1.0:
+        return 'short', 'text_only'
+    if spent >= BUDGET_SOFT_LIMIT:
+        if LENGTH_ORDER.index(length) > LENGTH_ORDER.index('medium'):
+            length = 'medium'
+        return length, 'bookends'
+    return length, None
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    user_id INTEGER NOT NULL,
+    day TEXT NOT NULL,
+    tokens_in INTEGER NOT NULL,
+    tokens_out INTEGER NOT NULL,
+    images INTEGER NOT NULL,
+    tts_chars INTEGER NOT NULL,
+    cost REAL NOT NULL,
+    stories INTEGER NOT NULL,
+    PRIMARY KEY (user_id, day)
+);
+"""
+
+
+class UsageStore:
+    """Дневные итоги USAGE в SQLite: загружаются при запуске и сохраняются раз в
+    METERING_FLUSH_SECONDS и при остановке. После падения теряется не больше
+    последнего интервала. Запросы к SQLite выполняются в потоке.
+    """
+    def __init__(self, path=METERING_PATH):
+        self.path = path
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    def _load(self, since):
+        with self._lock:
+            return self._connect().execute(
+                f'SELECT user_id, day, {", ".join(USAGE_FIELDS)} FROM usage WHERE day >= ?', (since,)
+            ).fetchall()
+
+    def _save(self, rows, cutoff):
+        with self._lock:
+            db = self._connect()
+            db.executemany(
+                f'INSERT OR REPLACE INTO usage (user_id, day, {", ".join(USAGE_FIELDS)}) '
+                f'VALUES (?, ?, {", ".join("?" * len(USAGE_FIELDS))})',
+                rows,
+            )
+            db.execute('DELETE FROM usage WHERE day < ?', (cutoff,))
+            db.commit()
+
+    async def load(self):
+        """Вернуть в USAGE итоги прошлых запусков (расходы, записанные до загрузки, складываются)"""
+        rows = await asyncio.to_thread(self._load, _cutoff())
+        for user_id, day, *values in rows:
+            usage = USAGE.setdefault((user_id, day), dict.fromkeys(USAGE_FIELDS, 0))
+            for name, value in zip(USAGE_FIELDS, values):
+                usage[name] += value
+        logging.info(f"Учёт расходов: загружено {len(rows)} дневных итогов из {self.path}")
+
+    async def flush(self):
+        """Сохранить изменившиеся итоги"""
+        keys = [key for key in _dirty if key in USAGE]
+        _dirty.clear()
+        if not keys:
+            return
+        rows = [(user_id, day, *(USAGE[(user_id, day)][name] for name in USAGE_FIELDS)) for user_id, day in keys]
+        try:
+            await asyncio.to_thread(self._save, rows, _cutoff())
+        except Exception as e:
+            _dirty.update(keys)
+            logging.warning(f"Не удалось сохранить учёт расходов в {self.path}: {e}")
+
+    async def run(self, interval=METERING_FLUSH_SECONDS):
+        """Фоновое сохранение итогов до отмены"""
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+def snapshot():
+    today = _today()
+    users = [u for (user_id, day), u in USAGE.items() if day == today]
+    costs = [c for _, c in STORY_COSTS]
+    return {
+        'users_today': len(users),
+        'cost_today': sum(u['cost'] for u in users),
+        'tokens_in_today': sum(u['tokens_in'] for u in users),
+        'tokens_out_today': sum(u['tokens_out'] for u in users),
+        'images_today': sum(u['images'] for u in users),
+        'tts_chars_today': sum(u['tts_chars'] for u in users),
+        'top_user_cost': max((u['cost'] for u in users), default=0.0),
+        'avg_story_cost': sum(costs) / len(costs) if costs else 0.0,
+        'avg_story_seconds': sum(s for s, _ in STORY_COSTS) / len(STORY_COSTS) if STORY_COSTS else 0.0,
+    }
@@ -0,0 +1,159 @@
+import os
+import time
+import random
+import logging
+from collections import deque
+from contextlib import contextmanager
+
+# --- Конфиг метрик ---
+# Порт HTTP эндпоинта /metrics в формате Prometheus, 0 — не запускать
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_HOST = os.getenv('METRICS_HOST', '0.0.0.0')
+# Доля запросов, для которых в лог пишутся полные промпты и ответы API
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', '0.01'))
+# Сколько последних замеров держать на этап для перцентилей
+RESERVOIR_SIZE = int(os.getenv('METRICS_RESERVOIR_SIZE', '1000'))
+
+# Границы бакетов гистограммы, секунды: от отправки сообщения до генерации картинки
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class Histogram:
+    """Гистограмма длительностей этапа: бакеты для Prometheus и окно для перцентилей"""
+    def __init__(self):
+        self.bucket_counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.errors = 0
+        self.recent = deque(maxlen=RESERVOIR_SIZE)
+
+    def observe(self, seconds, ok=True):
+        self.count += 1
+        self.sum += seconds
+        if not ok:
+            self.errors += 1
+        self.recent.append(seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.bucket_counts[i] += 1
+
+    def percentile(self, p):
+        values = sorted(self.recent)
+        if not values:
+            return None
+        return values[min(len(values) - 1, int(round(p * (len(values) - 1))))]
+
+
+# Этапы пайплайна -> гистограмма; этапы -> число выполняющихся сейчас
+HISTOGRAMS = {}
+IN_FLIGHT = {}
+COUNTERS = {}
+# Текущие значения (размер спула медиа и т.п.)
+GAUGES = {}
+
+
+def observe(stage, seconds, ok=True):
+    if stage not in HISTOGRAMS:
+        HISTOGRAMS[stage] = Histogram()
+    HISTOGRAMS[stage].observe(seconds, ok)
+
+
+def inc(name, value=1):
+    COUNTERS[name] = COUNTERS.get(name, 0) + value
+
+
+def gauge(name, value):
+    GAUGES[name] = value
+
+
+@contextmanager
+def span(stage):
+    """Замер этапа: длительность в гистограмму, ошибка — в счётчик ошибок этапа"""
+    IN_FLIGHT[stage] = IN_FLIGHT.get(stage, 0) + 1
+    started = time.monotonic()
+    ok = True
+    try:
+        yield
+    except BaseException:
+        ok = False
+        raise
+    finally:
+        IN_FLIGHT[stage] -= 1
+        observe(stage, time.monotonic() - started, ok)
+
+
+def should_log_payload():
+    """Сэмплирование подробных логов: полные промпты и ответы пишем не для каждого запроса"""
+    return LOG_PAYLOAD_SAMPLE_RATE >= 1 or random.random() < LOG_PAYLOAD_SAMPLE_RATE
+
+
+def stage_summary():
+    """p50/p95/p99 по этапам для /stats"""
+    return {
+        stage: {
+            'count': h.count,
+            'errors': h.errors,
+            'in_flight': IN_FLIGHT.get(stage, 0),
+            'p50': h.percentile(0.5),
+            'p95': h.percentile(0.95),
+            'p99': h.percentile(0.99),
+        }
+        for stage, h in sorted(HISTOGRAMS.items())
+    }
+
+
+def render_prometheus():
+    """Текстовый формат экспозиции Prometheus"""
+    lines = [
+        '# HELP bot_stage_duration_seconds Длительность этапов обработки',
+        '# TYPE bot_stage_duration_seconds histogram',
+    ]
+    for stage, h in sorted(HISTOGRAMS.items()):
+        for bound, count in zip(BUCKETS, h.bucket_counts):
+            lines.append(f'bot_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+        lines.append(f'bot_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {h.count}')
+        lines.append(f'bot_stage_duration_seconds_sum{{stage="{stage}"}} {h.sum}')
+        lines.append(f'bot_stage_duration_seconds_count{{stage="{stage}"}} {h.count}')
+    lines += [
+        '# HELP bot_stage_errors_total Ошибки этапов обработки',
+        '# TYPE bot_stage_errors_total counter',
+    ]
+    for stage, h in sorted(HISTOGRAMS.items()):
+        lines.append(f'bot_stage_errors_total{{stage="{stage}"}} {h.errors}')
+    lines += [
+        '# HELP bot_stage_in_flight Этапы, выполняющиеся сейчас',
+        '# TYPE bot_stage_in_flight gauge',
+    ]
+    for stage, value in sorted(IN_FLIGHT.items()):
+        lines.append(f'bot_stage_in_flight{{stage="{stage}"}} {value}')
+    lines += [
+        '# HELP bot_events_total Счётчики событий',
+        '# TYPE bot_events_total counter',
+    ]
+    for name, value in sorted(COUNTERS.items()):
+        lines.append(f'bot_events_total{{event="{name}"}} {value}')
+    lines += [
+        '# HELP bot_gauge Текущие значения',
+        '# TYPE bot_gauge gauge',
+    ]
+    for name, value in sorted(GAUGES.items()):
+        lines.append(f'bot_gauge{{name="{name}"}} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+async def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST):
+    """Поднять HTTP эндпоинт /metrics, вернуть runner для остановки (или None)"""
+    if not port:
+        return None
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=render_prometheus(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Метрики Prometheus доступны на http://{host}:{port}/metrics")
+    return runner
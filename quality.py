@@ -0,0 +1,169 @@
+import os
+import time
+import logging
+from collections import deque
+
+from resilience import get_breaker
+from llm_router import ROUTES
+
+# --- Конфиг адаптивного качества ---
+# Целевое время доставки сказки целиком (SLO), секунды
+STORY_SLO_SECONDS = float(os.getenv('STORY_SLO_SECONDS', '240'))
+# Окно наблюдений за бэкендами, секунды
+QUALITY_WINDOW_SECONDS = float(os.getenv('QUALITY_WINDOW_SECONDS', '600'))
+# Минимум замеров, прежде чем понижать качество по латентности
+QUALITY_MIN_SAMPLES = int(os.getenv('QUALITY_MIN_SAMPLES', '3'))
+# Доля ошибок Art, при которой переходим на сказку без картинок
+ART_MAX_ERROR_RATE = float(os.getenv('ART_MAX_ERROR_RATE', '0.5'))
+# Гистерезис: повышаем качество, только если оценка укладывается в эту долю SLO
+QUALITY_RECOVERY_FACTOR = float(os.getenv('QUALITY_RECOVERY_FACTOR', '0.8'))
+# Таймаут генерации одного изображения: обычный и нижняя граница при нагрузке
+ART_TIMEOUT = float(os.getenv('ART_TIMEOUT', '300'))
+ART_MIN_TIMEOUT = float(os.getenv('ART_MIN_TIMEOUT', '45'))
+
+# Режимы доставки сказки
+MODE_FULL = 'full'            # иллюстрация к каждой части
+MODE_BOOKENDS = 'bookends'    # только начальная и финальная иллюстрации
+MODE_TEXT_ONLY = 'text_only'  # без иллюстраций
+
+MODE_ORDER = [MODE_TEXT_ONLY, MODE_BOOKENDS, MODE_FULL]
+
+# Примерное число частей сказки по длине (части по ~10 предложений)
+EXPECTED_PARTS = {'short': 2, 'medium': 4, 'long': 7}
+
+
+class BackendWindow:
+    """Скользящее по времени окно замеров одного бэкенда"""
+    def __init__(self, window_seconds=QUALITY_WINDOW_SECONDS, maxlen=500):
+        self.window_seconds = window_seconds
+        self.samples = deque(maxlen=maxlen)
+
+    def record(self, seconds, ok):
+        self.samples.append((time.monotonic(), seconds, ok))
+
+    def _recent(self):
+        cutoff = time.monotonic() - self.window_seconds
+        while self.samples and self.samples[0][0] < cutoff:
+            self.samples.popleft()
+        return self.samples
+
+    def count(self):
+        return len(self._recent())
+
+    def error_rate(self):
+        recent = self._recent()
+        if not recent:
+            return 0.0
+        return sum(1 for _, _, ok in recent if not ok) / len(recent)
+
+    def percentile(self, p):
+        values = sorted(s for _, s, ok in self._recent() if ok)
+        if not values:
+            return None
+        return values[min(len(values) - 1, int(round(p * (len(values) - 1))))]
+
+
+class QualityController:
+    """Выбирает режим иллюстраций и таймауты по живой латентности и ошибкам бэкендов.
+
+    Окна ведутся отдельно для Art и каждой LLM модели: сказку пишет медленная
+    модель маршрута 'story', промпты картинок — быстрая модель маршрута 'prompt'.
+    TTS в доставку сказки не входит и не учитывается.
+    """
+    def __init__(self, slo=STORY_SLO_SECONDS, story_model=ROUTES['story']['primary'],
+                 prompt_model=ROUTES['prompt']['primary']):
+        self.slo = slo
+        self.story_backend = f"llm:{story_model}"
+        self.prompt_backend = f"llm:{prompt_model}"
+        self.backends = {'art': BackendWindow()}
+        self.mode = MODE_FULL
+        self.story_times = deque(maxlen=200)
+        self.transitions = deque(maxlen=50)
+
+    def observe(self, backend, seconds, ok):
+        """Слушатель resilience.call_backend: backend вида 'art', 'tts', 'llm:<модель>'"""
+        if backend == 'art' or backend.startswith('llm:'):
+            self.backends.setdefault(backend, BackendWindow()).record(seconds, ok)
+
+    def _p90(self, backend):
+        window = self.backends.get(backend)
+        return (window.percentile(0.9) if window else None) or 0.0
+
+    def estimate(self, mode, length=None):
+        """Оценка времени доставки сказки в заданном режиме по p90 бэкендов"""
+        story = self._p90(self.story_backend)
+        prompt = self._p90(self.prompt_backend)
+        art = self._p90('art')
+        parts = EXPECTED_PARTS.get(length, 4)
+        images = {MODE_FULL: parts + 1, MODE_BOOKENDS: 2, MODE_TEXT_ONLY: 0}[mode]
+        # Сказка пишется один раз; к каждой картинке — промпт от LLM и сама картинка Art, последовательно
+        return story + images * (prompt + art)
+
+    def choose_mode(self, length=None):
+        """Выбрать режим для новой сказки (или продолжения текущей)"""
+        art = self.backends['art']
+        if get_breaker('art').is_open:
+            target = MODE_TEXT_ONLY
+        elif art.count() >= QUALITY_MIN_SAMPLES and art.error_rate() >= ART_MAX_ERROR_RATE:
+            target = MODE_TEXT_ONLY
+        elif art.count() < QUALITY_MIN_SAMPLES:
+            target = MODE_FULL
+        else:
+            target = MODE_TEXT_ONLY
+            for mode in (MODE_FULL, MODE_BOOKENDS):
+                budget = self.slo
+                # Повышение качества требует запаса, чтобы не переключаться туда-обратно
+                if MODE_ORDER.index(mode) > MODE_ORDER.index(self.mode):
+                    budget *= QUALITY_RECOVERY_FACTOR
+                if self.estimate(mode, length) <= budget:
+                    target = mode
+                    break
+        self._set_mode(target)
+        return target
+
+    def _set_mode(self, mode):
+        if mode == self.mode:
+            return
+        logging.warning(f"Качество иллюстраций: {self.mode} -> {mode}")
+        self.transitions.append({'ts': time.time(), 'from': self.mode, 'to': mode})
+        self.mode = mode
+
+    def art_timeout(self):
+        """Таймаут одной картинки: сжимается под нагрузкой, но не ниже ART_MIN_TIMEOUT"""
+        if self.mode == MODE_FULL:
+            return ART_TIMEOUT
+        p90 = self.backends['art'].percentile(0.9)
+        if p90 is None:
+            return ART_TIMEOUT
+        return max(ART_MIN_TIMEOUT, min(ART_TIMEOUT, p90 * 1.5))
+
+    def record_story(self, seconds):
+        self.story_times.append(seconds)
+        if seconds > self.slo:
+            logging.warning(f"Сказка доставлена за {seconds:.0f}с, это больше SLO {self.slo:.0f}с")
+
+    def snapshot(self):
+        within = sum(1 for t in self.story_times if t <= self.slo)
+        return {
+            'mode': self.mode,
+            'art_timeout': self.art_timeout(),
+            'stories': len(self.story_times),
+            'within_slo': within,
+            'backends': {
+                name: {
+                    'count': w.count(),
+                    'error_rate': w.error_rate(),
+                    'p90': w.percentile(0.9),
+                }
+                for name, w in self.backends.items()
+            },
+        }
+
+
+def should_illustrate(mode, index, total):
+    """Нужна ли иллюстрация к части index (0..total-1) в данном режиме"""
+    if mode == MODE_FULL:
+        return True
+    if mode == MODE_BOOKENDS:
+        return index == total - 1
+    return False
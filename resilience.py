@@ -0,0 +1,176 @@
+import os
+import time
+import random
+import asyncio
+import logging
+
+# --- Конфиг повторов и предохранителей ---
+RETRY_ATTEMPTS = int(os.getenv('RETRY_ATTEMPTS', '3'))
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', '0.5'))
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', '8'))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', '5'))
+BREAKER_RESET_TIMEOUT = float(os.getenv('BREAKER_RESET_TIMEOUT', '60'))
+
+# HTTP статусы, при которых запрос имеет смысл повторить
+RETRYABLE_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+
+class BackendError(Exception):
+    """Ошибка внешнего бэкенда с HTTP статусом (если он есть)"""
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+    @property
+    def retryable(self):
+        return self.status is None or self.status in RETRYABLE_STATUSES
+
+
+class CircuitOpenError(Exception):
+    """Предохранитель бэкенда разомкнут — запрос не отправляется"""
+    def __init__(self, backend):
+        super().__init__(f"Бэкенд {backend} временно недоступен")
+        self.backend = backend
+
+
+def is_retryable(exc):
+    """Можно ли повторить запрос после такой ошибки"""
+    if isinstance(exc, CircuitOpenError):
+        return False
+    if isinstance(exc, BackendError):
+        return exc.retryable
+    status = getattr(exc, 'status', None)
+    if isinstance(status, int):
+        return status in RETRYABLE_STATUSES
+    return isinstance(exc, (asyncio.TimeoutError, ConnectionError, OSError))
+
+
+def backoff_delay(attempt, base=RETRY_BASE_DELAY, cap=RETRY_MAX_DELAY):
+    """Экспоненциальная задержка с полным джиттером: U(0, min(cap, base * 2^attempt))"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+async def retry_async(func, *args, attempts=RETRY_ATTEMPTS, base_delay=RETRY_BASE_DELAY,
+                      max_delay=RETRY_MAX_DELAY, name='backend', **kwargs):
+    """Вызвать корутину func с повторами на временных ошибках"""
+    for attempt in range(attempts):
+        try:
+            return await func(*args, **kwargs)
+        except Exception as e:
+            if attempt == attempts - 1 or not is_retryable(e):
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            logging.warning(f"{name}: попытка {attempt + 1}/{attempts} не удалась ({e}), повтор через {delay:.2f}с")
+            await asyncio.sleep(delay)
+
+
+class CircuitBreaker:
+    """Предохранитель: после серии ошибок размыкается и отклоняет запросы,
+    по истечении reset_timeout пропускает один пробный запрос (half-open)"""
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+
+    def _maybe_half_open(self):
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            logging.info(f"Предохранитель {self.name}: пробный запрос (half-open)")
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+
+    @property
+    def is_open(self):
+        """Разомкнут ли предохранитель (с учётом истечения reset_timeout)"""
+        self._maybe_half_open()
+        return self.state == self.OPEN
+
+    def allow(self):
+        """Можно ли сейчас отправить запрос"""
+        self._maybe_half_open()
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logging.info(f"Предохранитель {self.name}: бэкенд восстановился, замыкаем")
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logging.warning(f"Предохранитель {self.name}: размыкаем после {self.failures} ошибок")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+    def snapshot(self):
+        self._maybe_half_open()
+        return {'state': self.state, 'failures': self.failures}
+
+
+# --- Реестр предохранителей по бэкендам ---
+BREAKERS = {}
+
+# Слушатели исходов вызовов: fn(backend, seconds, ok)
+OBSERVERS = []
+
+
+def add_observer(func):
+    OBSERVERS.append(func)
+
+
+def _notify(name, seconds, ok):
+    for func in OBSERVERS:
+        try:
+            func(name, seconds, ok)
+        except Exception as e:
+            logging.warning(f"Ошибка слушателя {func}: {e}")
+
+
+def get_breaker(name):
+    if name not in BREAKERS:
+        BREAKERS[name] = CircuitBreaker(name)
+    return BREAKERS[name]
+
+
+async def call_backend(name, func, *args, retry=True, **kwargs):
+    """Вызов бэкенда через предохранитель и (опционально) повторы с backoff"""
+    breaker = get_breaker(name)
+    if not breaker.allow():
+        raise CircuitOpenError(name)
+    started = time.monotonic()
+    try:
+        if retry:
+            result = await retry_async(func, *args, name=name, **kwargs)
+        else:
+            result = await func(*args, **kwargs)
+    except asyncio.CancelledError:
+        # Отмена (например, проигравший хедж-запрос) — не ошибка бэкенда
+        breaker._probe_in_flight = False
+        raise
+    except Exception as e:
+        # Ошибки клиента (4xx, кроме временных) не говорят о недоступности бэкенда
+        if is_retryable(e) or not isinstance(e, BackendError):
+            breaker.record_failure()
+            _notify(name, time.monotonic() - started, False)
+        else:
+            breaker.record_success()
+        raise
+    breaker.record_success()
+    _notify(name, time.monotonic() - started, True)
+    return result
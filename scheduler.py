@@ -0,0 +1,245 @@
+import os
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import metering
+
+# --- Конфиг планировщика ---
+# Апдейтов Telegram, обрабатываемых одновременно (апдейты одного пользователя — всегда по порядку)
+INTERACTIVE_CONCURRENCY = int(os.getenv('INTERACTIVE_CONCURRENCY', '64'))
+# Одновременных операций Art и запросов TTS на весь бот; очередь делится между пользователями по кругу
+ART_CONCURRENCY = int(os.getenv('ART_CONCURRENCY', '8'))
+TTS_CONCURRENCY = int(os.getenv('TTS_CONCURRENCY', '4'))
+# Потоков для блокирующей работы: запись и чтение файлов, разбор больших ответов
+BLOCKING_WORKERS = int(os.getenv('BLOCKING_WORKERS', '4'))
+# Остановка бота: сколько секунд ждать, пока фоновые задачи допишут сказки и озвучку,
+# и сколько дать прерванным задачам на сохранение прогресса и сообщение пользователю
+DRAIN_TIMEOUT = float(os.getenv('DRAIN_TIMEOUT', '60'))
+DRAIN_GRACE = float(os.getenv('DRAIN_GRACE', '5'))
+
+
+class FairLimiter:
+    """Ограничение одновременных задач с честной очередью: свободный слот достаётся
+    следующему по кругу пользователю, а не тому, кто поставил в очередь больше задач"""
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.active = 0
+        self.waiting = 0
+        self._queues = OrderedDict()
+
+    async def acquire(self, key):
+        if self.active < self.limit and not self._queues:
+            self.active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(key, deque()).append(future)
+        self.waiting += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Слот уже передали нам — отдаём следующему
+                self.release()
+            else:
+                self._discard(key, future)
+            raise
+        finally:
+            self.waiting -= 1
+
+    def _discard(self, key, future):
+        queue = self._queues.get(key)
+        if queue and future in queue:
+            queue.remove(future)
+            if not queue:
+                del self._queues[key]
+
+    def release(self):
+        """Передать слот первому ожидающему следующего пользователя или освободить его"""
+        while self._queues:
+            key, queue = next(iter(self._queues.items()))
+            future = queue.popleft()
+            if queue:
+                self._queues.move_to_end(key)
+            else:
+                del self._queues[key]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def snapshot(self):
+        return {'limit': self.limit, 'active': self.active, 'waiting': self.waiting, 'users': len(self._queues)}
+
+
+# Фоновый уровень: медленные обращения к бэкендам, ограниченные и честные между пользователями
+TIERS = {
+    'art': FairLimiter('art', ART_CONCURRENCY),
+    'tts': FairLimiter('tts', TTS_CONCURRENCY),
+}
+
+# Долгие задачи пользователей (сказка, озвучка): user_id -> задачи
+JOBS = {}
+
+_blocking_pool = None
+# Бот останавливается: новые фоновые задачи не запускаются
+_draining = False
+
+
+async def run_background(tier, func, *args, **kwargs):
+    """Выполнить func в фоновом уровне tier: ждём свой слот в очереди текущего пользователя"""
+    limiter = TIERS[tier]
+    with metrics.span(f'queue_{tier}'):
+        await limiter.acquire(metering.current_user())
+    try:
+        return await func(*args, **kwargs)
+    finally:
+        limiter.release()
+
+
+async def run_blocking(func, *args):
+    """Выполнить блокирующую функцию в пуле потоков, не останавливая цикл событий"""
+    global _blocking_pool
+    if _blocking_pool is None:
+        _blocking_pool = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix='blocking')
+    return await asyncio.get_running_loop().run_in_executor(_blocking_pool, func, *args)
+
+
+def interactive_processor(limit=INTERACTIVE_CONCURRENCY):
+    """Обработчик апдейтов для ApplicationBuilder.concurrent_updates: разные пользователи
+    обрабатываются параллельно, апдейты одного пользователя — строго по порядку"""
+    from telegram.ext import BaseUpdateProcessor
+
+    class UserOrderedProcessor(BaseUpdateProcessor):
+        def __init__(self, max_concurrent_updates):
+            super().__init__(max_concurrent_updates)
+            self._locks = {}
+            self._pending = {}
+
+        async def do_process_update(self, update, coroutine):
+            user = getattr(update, 'effective_user', None)
+            key = user.id if user else None
+            lock = self._locks.setdefault(key, asyncio.Lock())
+            self._pending[key] = self._pending.get(key, 0) + 1
+            try:
+                async with lock:
+                    await coroutine
+            finally:
+                self._pending[key] -= 1
+                if not self._pending[key]:
+                    del self._pending[key]
+                    del self._locks[key]
+
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+    return UserOrderedProcessor(limit)
+
+
+def spawn(key, coro, name='job'):
+    """Запустить долгую задачу пользователя в фоне: хэндлер возвращается сразу,
+    и следующие апдейты пользователя (и его кнопки) не ждут генерацию.
+    Во время остановки бота задача не запускается, возвращается None"""
+    if _draining:
+        coro.close()
+        logging.info(f"Бот останавливается, задача {name} пользователя {key} не запущена")
+        metrics.inc('jobs_refused')
+        return None
+    task = asyncio.create_task(coro, name=f'{name}:{key}')
+    JOBS.setdefault(key, set()).add(task)
+
+    def done(task):
+        jobs = JOBS.get(key)
+        if jobs is not None:
+            jobs.discard(task)
+            if not jobs:
+                del JOBS[key]
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"Фоновая задача {name} пользователя {key} упала: {task.exception()!r}")
+
+    task.add_done_callback(done)
+    return task
+
+
+def background(handler, name='job', refused=None):
+    """Обёртка хэндлера команды: всё тело выполняется фоновой задачей пользователя.
+    refused(update, context) отвечает пользователю, если бот уже останавливается"""
+    async def run(update, context):
+        if spawn(update.effective_user.id, handler(update, context), name) is None and refused is not None:
+            await refused(update, context)
+    run.__name__ = handler.__name__
+    return run
+
+
+def jobs_for(key, *names):
+    """Фоновые задачи пользователя; с names — только задачи с такими именами"""
+    jobs = set(JOBS.get(key, ()))
+    if names:
+        jobs = {task for task in jobs if task.get_name().split(':', 1)[0] in names}
+    return jobs
+
+
+async def join(key=None):
+    """Дождаться фоновых задач пользователя (или всех, если key не задан)"""
+    while True:
+        tasks = jobs_for(key) if key is not None else all_jobs()
+        if not tasks:
+            return
+        await asyncio.wait(tasks)
+
+
+def is_draining():
+    return _draining
+
+
+def all_jobs():
+    return {t for jobs in JOBS.values() for t in jobs}
+
+
+async def drain(timeout=DRAIN_TIMEOUT, grace=DRAIN_GRACE):
+    """Остановка: перестать принимать задачи, дать текущим закончиться за timeout секунд,
+    оставшиеся отменить — у них есть grace секунд, чтобы сохранить прогресс.
+    Возвращает число задач: закончились, прерваны, брошены (не ответили на отмену)"""
+    global _draining
+    _draining = True
+    tasks = all_jobs()
+    if not tasks:
+        return {'finished': 0, 'cancelled': 0, 'abandoned': 0}
+    logging.info(f"Остановка: ждём {len(tasks)} фоновых задач до {timeout:.0f}с")
+    _, pending = await asyncio.wait(tasks, timeout=timeout) if timeout > 0 else (set(), tasks)
+    abandoned = set()
+    if pending:
+        logging.warning(f"Остановка: {len(pending)} задач не успели, прерываем")
+        for task in pending:
+            task.cancel()
+        _, abandoned = await asyncio.wait(pending, timeout=grace)
+        if abandoned:
+            logging.error(f"Остановка: {len(abandoned)} задач не завершились после отмены")
+    result = {'finished': len(tasks) - len(pending), 'cancelled': len(pending) - len(abandoned), 'abandoned': len(abandoned)}
+    for outcome, count in result.items():
+        metrics.inc(f'drain_{outcome}', count)
+    logging.info(f"Остановка: задач завершено {result['finished']}, прервано {result['cancelled']}, "
+                 f"брошено {result['abandoned']}")
+    return result
+
+
+def close():
+    """Остановить пул потоков блокирующей работы"""
+    global _blocking_pool
+    if _blocking_pool is not None:
+        _blocking_pool.shutdown(wait=True)
+        _blocking_pool = None
+
+
+def snapshot():
+    return {
+        'draining': _draining,
+        'jobs': sum(len(jobs) for jobs in JOBS.values()),
+        'tiers': {name: limiter.snapshot() for name, limiter in TIERS.items()},
+    }
@@ -0,0 +1,66 @@
+import asyncio
+import hashlib
+import logging
+
+
+def normalize_key(*parts):
+    """Ключ запроса: регистр и пробелы не различаются"""
+    text = '\x1f'.join(' '.join(str(p).split()).lower() for p in parts)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class _Flight:
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Объединяет одновременные одинаковые запросы в один вызов бэкенда.
+
+    Первый вызов с ключом запускает задачу, остальные ждут её же результата
+    или исключения. Отмена одного ожидающего не трогает задачу, пока есть
+    другие; когда уходит последний, задача отменяется. После завершения ключ
+    забывается — это не кэш, повторный запрос пойдёт в бэкенд заново.
+    """
+    def __init__(self, name):
+        self.name = name
+        self._flights = {}
+        self.started = 0
+        self.coalesced = 0
+
+    async def do(self, key, func, *args, **kwargs):
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(func(*args, **kwargs)))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _, key=key, flight=flight: self._forget(key, flight))
+            self.started += 1
+        else:
+            self.coalesced += 1
+            logging.info(f"{self.name}: присоединяемся к уже идущему запросу ({flight.waiters} ожидают)")
+        flight.waiters += 1
+        try:
+            # shield: отмена этого ожидающего не отменяет общую задачу
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                logging.info(f"{self.name}: все ожидающие ушли, отменяем запрос")
+                # Забываем ключ сразу: новый вызов до done-callback начнёт свой запрос, а не получит отмену
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                flight.task.cancel()
+
+    def _forget(self, key, flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        # Исключение забирают ожидающие; если их не осталось — не шумим в лог
+        if not flight.task.cancelled():
+            flight.task.exception()
+
+    def in_flight(self):
+        return len(self._flights)
+
+    def snapshot(self):
+        return {'in_flight': self.in_flight(), 'started': self.started, 'coalesced': self.coalesced}
@@ -0,0 +1,287 @@
+import os
+import time
+import errno
+import asyncio
+import logging
+import tempfile
+import itertools
+
+import metrics
+import scheduler
+
+# --- Конфиг спула медиафайлов ---
+# Каталог для картинок и аудио перед отправкой в Telegram. Может быть общим для нескольких процессов:
+# файлы называются <pid>-<n>, при запуске удаляются только файлы завершившихся процессов
+MEDIA_SPOOL_DIR = os.getenv('MEDIA_SPOOL_DIR') or os.path.join(tempfile.gettempdir(), 'storyteller-spool')
+# Квота на диске: при превышении вытесняются утечки, файлы в работе не трогаются (только предупреждение)
+MEDIA_SPOOL_MAX_MB = float(os.getenv('MEDIA_SPOOL_MAX_MB', '200'))
+# Файл отправляется за секунды; живущий дольше MEDIA_SPOOL_MAX_AGE секунд считается утечкой и удаляется
+MEDIA_SPOOL_MAX_AGE = float(os.getenv('MEDIA_SPOOL_MAX_AGE', '1800'))
+# Как часто проверять спул на утечки и посторонние файлы (при очередной записи)
+MEDIA_SPOOL_SWEEP_SECONDS = 300
+
+
+def write_file(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def list_files(directory):
+    """Файлы каталога: имя -> размер"""
+    with os.scandir(directory) as entries:
+        return {entry.name: entry.stat().st_size for entry in entries if entry.is_file()}
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Процесс есть, но принадлежит другому пользователю
+        return True
+    return True
+
+
+class _Entry:
+    def __init__(self, path, key=None):
+        self.path = path
+        self.key = key
+        self.size = 0
+        self.created = time.monotonic()
+        self.refs = 1
+        # Для записи по ключу: True, когда файл записан (False — запись не удалась)
+        self.ready = None
+
+
+class SpoolFile:
+    """Ссылка на файл спула: файл удаляется, когда освобождена последняя ссылка"""
+    def __init__(self, spool, entry):
+        self._spool = spool
+        self._entry = entry
+        self.released = False
+
+    @property
+    def path(self):
+        return self._entry.path
+
+    @property
+    def size(self):
+        return self._entry.size
+
+    def open(self):
+        return open(self._entry.path, 'rb')
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self._spool._release(self._entry)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class MediaSpool:
+    """Временные медиафайлы бота в отдельном каталоге с учётом ссылок.
+
+    Каждый, кто отправляет файл, держит свою ссылку (SpoolFile) и освобождает её
+    после отправки; одинаковые картинки одного single-flight запроса пишутся на
+    диск один раз и делят файл по ключу. Файлы, живущие дольше max_age, считаются
+    утечкой и удаляются; при превышении квоты вытесняются только такие утечки, а
+    файлы в работе остаются и квота превышается с предупреждением. При запуске
+    из каталога удаляются файлы завершившихся процессов, при остановке — свои файлы;
+    файлы других живых процессов в общем каталоге не трогаются.
+    """
+    def __init__(self, directory=MEDIA_SPOOL_DIR, max_bytes=MEDIA_SPOOL_MAX_MB * 1e6, max_age=MEDIA_SPOOL_MAX_AGE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.bytes = 0
+        self._entries = {}
+        self._keys = {}
+        self._names = itertools.count(1)
+        self._last_sweep = time.monotonic()
+        self._started = False
+        self.stats = {'written': 0, 'shared': 0, 'removed': 0, 'evicted': 0, 'leaked': 0, 'orphans': 0}
+
+    def _new_entry(self, suffix, key=None):
+        path = os.path.join(self.directory, f"{os.getpid()}-{next(self._names)}{suffix}")
+        entry = self._entries[path] = _Entry(path, key)
+        return entry
+
+    def _set_size(self, entry, size):
+        self.bytes += size - entry.size
+        entry.size = size
+        self._update_gauges()
+
+    def _update_gauges(self):
+        metrics.gauge('spool_files', len(self._entries))
+        metrics.gauge('spool_bytes', self.bytes)
+
+    def _release(self, entry):
+        entry.refs -= 1
+        if entry.refs <= 0 and entry.path in self._entries:
+            self._remove(entry)
+            self.stats['removed'] += 1
+
+    def _remove(self, entry):
+        if self._entries.pop(entry.path, None) is None:
+            return
+        if entry.key is not None and self._keys.get(entry.key) is entry:
+            del self._keys[entry.key]
+        self.bytes -= entry.size
+        try:
+            os.unlink(entry.path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning(f"Не удалось удалить файл спула {entry.path}: {e}")
+        self._update_gauges()
+
+    def _make_room(self, size):
+        """Освободить место под новый файл: вытесняются только утечки (старше max_age).
+
+        Остальные файлы кто-то держит и ещё отправит; их не трогаем — квота
+        превышается с предупреждением.
+        """
+        if self.bytes + size <= self.max_bytes:
+            return
+        now = time.monotonic()
+        for entry in sorted(self._entries.values(), key=lambda e: e.created):
+            if self.bytes + size <= self.max_bytes or now - entry.created <= self.max_age:
+                break
+            logging.warning(f"Спул медиа превысил квоту {self.max_bytes / 1e6:g} МБ, вытесняем утечку {entry.path} "
+                            f"({entry.size} байт, ссылок {entry.refs}, возраст {now - entry.created:.0f}с)")
+            self._remove(entry)
+            self.stats['evicted'] += 1
+            metrics.inc('spool_evicted')
+        if self.bytes + size > self.max_bytes:
+            logging.warning(f"Спул медиа превысил квоту {self.max_bytes / 1e6:g} МБ: "
+                            f"{len(self._entries)} файлов в работе, {(self.bytes + size) / 1e6:.1f} МБ")
+            metrics.inc('spool_over_quota')
+
+    async def start(self):
+        """Создать каталог и удалить файлы, оставшиеся от прошлого запуска"""
+        self._started = True
+        await scheduler.run_blocking(os.makedirs, self.directory, 0o700, True)
+        await self.sweep()
+
+    async def write(self, data, suffix, key=None):
+        """Записать файл в спул, вернуть ссылку на него. Для уже записанного key — новая ссылка на тот же файл"""
+        entry = self._keys.get(key) if key is not None else None
+        if entry is not None:
+            # Тот же файл уже пишется или записан: берём ссылку и ждём окончания записи
+            entry.refs += 1
+            handle = SpoolFile(self, entry)
+            try:
+                written = await asyncio.shield(entry.ready)
+            except BaseException:
+                handle.release()
+                raise
+            if not written:
+                handle.release()
+                raise OSError(f"Не удалось записать файл спула {entry.path}")
+            self.stats['shared'] += 1
+            return handle
+        if not self._started:
+            await self.start()
+        elif time.monotonic() - self._last_sweep > MEDIA_SPOOL_SWEEP_SECONDS:
+            await self.sweep()
+        self._make_room(len(data))
+        entry = self._new_entry(suffix, key)
+        entry.ready = asyncio.get_running_loop().create_future()
+        if key is not None:
+            self._keys[key] = entry
+        try:
+            await scheduler.run_blocking(write_file, entry.path, data)
+        except BaseException:
+            entry.ready.set_result(False)
+            self._remove(entry)
+            raise
+        entry.ready.set_result(True)
+        self._set_size(entry, len(data))
+        self.stats['written'] += 1
+        return SpoolFile(self, entry)
+
+    def reserve(self, suffix):
+        """Ссылка на новый путь в спуле для файла, который запишет внешний процесс (ffmpeg)"""
+        return SpoolFile(self, self._new_entry(suffix))
+
+    def commit(self, handle):
+        """Учесть размер файла, записанного по пути из reserve"""
+        try:
+            self._set_size(handle._entry, os.path.getsize(handle.path))
+            self.stats['written'] += 1
+        except OSError:
+            pass
+
+    async def sweep(self):
+        """Удалить утечки (файлы старше max_age) и чужие брошенные файлы каталога"""
+        self._last_sweep = time.monotonic()
+        for entry in [e for e in self._entries.values() if self._last_sweep - e.created > self.max_age]:
+            logging.warning(f"Утечка в спуле медиа: {entry.path} держится {self._last_sweep - entry.created:.0f}с "
+                            f"(ссылок {entry.refs}), удаляем")
+            self._remove(entry)
+            self.stats['leaked'] += 1
+            metrics.inc('spool_leaked')
+        try:
+            files = await scheduler.run_blocking(list_files, self.directory)
+        except FileNotFoundError:
+            return
+        orphans = {name: size for name, size in files.items()
+                   if os.path.join(self.directory, name) not in self._entries and self._is_orphan(name)}
+        for name in orphans:
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+        if orphans:
+            self.stats['orphans'] += len(orphans)
+            metrics.inc('spool_orphans', len(orphans))
+            logging.warning(f"Спул медиа: удалено {len(orphans)} брошенных файлов "
+                            f"({sum(orphans.values()) / 1e6:.1f} МБ)")
+
+    def _is_orphan(self, name):
+        """Файл, которого нет в _entries: чей он и жив ли владелец.
+
+        Каталог может быть общим для нескольких процессов (второй экземпляр бота,
+        бенчмарк), поэтому файлы живых процессов не трогаем. Имя начинается с pid
+        владельца: наш pid — файл прошлого процесса с тем же pid (перезапуск
+        контейнера), мёртвый pid — файл упавшего процесса. Файлы без pid в имени
+        удаляются, только когда они старше max_age.
+        """
+        pid = name.split('-', 1)[0]
+        if not pid.isdigit():
+            try:
+                return time.time() - os.path.getmtime(os.path.join(self.directory, name)) > self.max_age
+            except OSError:
+                return False
+        return int(pid) == os.getpid() or not pid_alive(int(pid))
+
+    def clear(self):
+        """Остановка бота: удалить свои файлы спула и сам каталог, если он опустел"""
+        self._started = False
+        held = [e for e in self._entries.values() if e.refs > 0]
+        if held:
+            logging.warning(f"Спул медиа: при остановке не освобождено {len(held)} файлов")
+            self.stats['leaked'] += len(held)
+        for entry in list(self._entries.values()):
+            self._remove(entry)
+        prefix = f"{os.getpid()}-"
+        try:
+            for name in os.listdir(self.directory):
+                if name.startswith(prefix):
+                    os.unlink(os.path.join(self.directory, name))
+            os.rmdir(self.directory)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            # В каталоге остались файлы других процессов — он им ещё нужен
+            if e.errno != errno.ENOTEMPTY:
+                logging.warning(f"Не удалось очистить спул медиа {self.directory}: {e}")
+
+    def snapshot(self):
+        return dict(self.stats, files=len(self._entries), bytes=self.bytes, max_bytes=self.max_bytes)